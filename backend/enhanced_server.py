@@ -8,6 +8,12 @@
 from datetime import datetime, timedelta
 from typing import List, Optional, Dict, Any
 from enum import Enum
+import functools
+import string
+from fastapi import Query, WebSocket
+from fastapi.encoders import jsonable_encoder
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 class UserType(str, Enum):
     STUDENT = "student"
@@ -68,24 +74,150 @@ class SessionCreate(BaseModel):
 class Session(SessionCreate):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     student_id: str
+    enrolled: int = Field(1, description="عدد الطلاب المسجلين (يشمل منشئ الجلسة)")
     status: SessionStatus = SessionStatus.PENDING
+    starts_at: Optional[datetime] = Field(None, description="بداية الجلسة بتوقيت UTC")
+    ends_at: Optional[datetime] = Field(None, description="نهاية الجلسة بتوقيت UTC")
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: Optional[datetime] = None
 
+class SessionEnrollment(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    session_id: str
+    student_id: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+SESSION_PROJECTION = {"_id": 0, **{field: 1 for field in Session.__fields__}}
+
 # ===== نماذج الإشعارات =====
 class NotificationCreate(BaseModel):
     user_id: str
     user_type: UserType
     notification_type: NotificationType
-    title: Dict[str, str] = Field(..., description="العنوان بالغات المختلفة")
-    message: Dict[str, str] = Field(..., description="الرسالة بالغات المختلفة")
+    params: Dict[str, Any] = Field(default_factory=dict, description="متغيرات قالب الإشعار")
     data: Optional[Dict[str, Any]] = Field(None, description="بيانات إضافية")
 
 class Notification(NotificationCreate):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    # الإشعارات القديمة كانت تخزن النص بكل اللغات
+    title: Optional[Dict[str, str]] = None
+    message: Optional[Dict[str, str]] = None
     is_read: bool = False
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class NotificationView(BaseModel):
+    id: str
+    user_id: str
+    user_type: UserType
+    notification_type: NotificationType
+    language: str
+    title: str
+    message: str
+    data: Optional[Dict[str, Any]] = None
+    is_read: bool
+    created_at: datetime
+
+# ===== قوالب الإشعارات =====
+# النص يُبنى عند القراءة بلغة المستخدم؛ المستند يخزن نوع الإشعار ومتغيراته فقط
+SUPPORTED_LANGUAGES = ("ar", "en", "ur")
+
+NOTIFICATION_TEMPLATES = {
+    NotificationType.RATING_RECEIVED: {
+        "title": {
+            "ar": "تقييم جديد",
+            "en": "New Rating",
+            "ur": "نئی درجہ بندی"
+        },
+        "message": {
+            "ar": "حصلت على تقييم {rating} نجوم من {student_name}",
+            "en": "You received {rating} stars rating from {student_name}",
+            "ur": "آپ کو {student_name} سے {rating} ستارے کی درجه بندی ملی"
+        }
+    },
+    NotificationType.BOOKING_CONFIRMED: {
+        "title": {
+            "ar": "حجز جلسة جديدة",
+            "en": "New Session Booking",
+            "ur": "نیا سیشن بکنگ"
+        },
+        "message": {
+            "ar": "طالب جديد {student_name} حجز جلسة معك",
+            "en": "New student {student_name} booked a session with you",
+            "ur": "نیا طالب {student_name} نے آپ کے ساتھ سیشن بک کیا"
+        }
+    },
+    NotificationType.SESSION_REMINDER: {
+        "title": {
+            "ar": "تذكير بالجلسة",
+            "en": "Session Reminder",
+            "ur": "سیشن کی یاد دہانی"
+        },
+        "message": {
+            "ar": "جلسة {subject} تبدأ بعد {minutes} دقيقة",
+            "en": "Your {subject} session starts in {minutes} minutes",
+            "ur": "آپ کا {subject} سیشن {minutes} منٹ میں شروع ہوگا"
+        }
+    },
+    NotificationType.NEW_MESSAGE: {
+        "title": {
+            "ar": "رسالة جديدة",
+            "en": "New Message",
+            "ur": "نیا پیغام"
+        },
+        "message": {
+            "ar": "رسالة جديدة من {sender_name}",
+            "en": "New message from {sender_name}",
+            "ur": "{sender_name} سے نیا پیغام"
+        }
+    }
+}
+
+def _compile_template(text: str):
+    parts = list(string.Formatter().parse(text))
+    
+    def render(params: dict) -> str:
+        rendered = []
+        for literal, field, spec, _ in parts:
+            rendered.append(literal)
+            if field is not None:
+                value = params.get(field, "")
+                rendered.append(format(value, spec) if spec else str(value))
+        return "".join(rendered)
+    return render
+
+@functools.lru_cache(maxsize=256)
+def compiled_notification_template(notification_type: str, language: str):
+    """القالب المُحلَّل مسبقاً لكل (نوع، لغة)"""
+    template = NOTIFICATION_TEMPLATES[NotificationType(notification_type)]
+    language = language if language in template["title"] else "en"
+    return _compile_template(template["title"][language]), _compile_template(template["message"][language])
+
+def _pick_language(texts: Dict[str, str], language: str) -> str:
+    return texts.get(language) or texts.get("en") or next(iter(texts.values()), "")
+
+def render_notification_text(notification: dict, language: str):
+    """عنوان ونص الإشعار بلغة معينة"""
+    if notification.get("title"):
+        return _pick_language(notification["title"], language), _pick_language(notification.get("message") or {}, language)
+    render_title, render_message = compiled_notification_template(
+        NotificationType(notification["notification_type"]).value, language
+    )
+    params = notification.get("params") or {}
+    return render_title(params), render_message(params)
+
+def render_notification(notification: dict, language: str) -> NotificationView:
+    title, message = render_notification_text(notification, language)
+    return NotificationView(**{
+        **notification,
+        "language": language,
+        "title": title,
+        "message": message
+    })
+
+def user_language(current_user: dict) -> str:
+    language = (current_user.get("preferences") or {}).get("language", "ar")
+    return language if language in SUPPORTED_LANGUAGES else "ar"
+
 # ===== نماذج الرسائل المحسنة =====
 class MessageCreate(BaseModel):
     receiver_id: str = Field(..., description="معرف المستقبل")
@@ -95,6 +227,7 @@ class MessageCreate(BaseModel):
 
 class Message(MessageCreate):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    conversation_id: Optional[str] = None
     sender_id: str
     sender_type: UserType
     is_read: bool = False
@@ -106,16 +239,742 @@ async def get_user_by_id_and_type(user_id: str, user_type: UserType):
     collection = db.students if user_type == UserType.STUDENT else db.teachers
     return await collection.find_one({"id": user_id})
 
+STUDENT_NAME_CACHE_SECONDS = 300
+STUDENT_NAME_CACHE_MAX_ENTRIES = 10000
+_student_names = OrderedDict()  # student_id -> (name, expires_at)
+
+async def get_student_names(student_ids: set) -> Dict[str, str]:
+    """أسماء الطلاب من الذاكرة المؤقتة، والباقي باستعلام $in واحد"""
+    now = time.monotonic()
+    names = {}
+    missing = []
+    for student_id in student_ids:
+        cached = _student_names.get(student_id)
+        if cached is not None and cached[1] > now:
+            names[student_id] = cached[0]
+        else:
+            missing.append(student_id)
+    
+    if missing:
+        students = await db.students.find(
+            {"id": {"$in": missing}}, {"_id": 0, "id": 1, "name": 1}
+        ).to_list(len(missing))
+        for student in students:
+            names[student["id"]] = student["name"]
+            _student_names.pop(student["id"], None)
+            _student_names[student["id"]] = (student["name"], now + STUDENT_NAME_CACHE_SECONDS)
+        while len(_student_names) > STUDENT_NAME_CACHE_MAX_ENTRIES:
+            _student_names.popitem(last=False)
+    
+    return names
+
+# ===== إحصائيات المعلمين المجمّعة (teacher_stats) =====
+# مستند واحد لكل معلم يُحدَّث بـ $inc عند كل تقييم أو جلسة مكتملة، ويعاد بناؤه دورياً
+TEACHER_STATS_RECONCILE_SECONDS = int(os.environ.get('TEACHER_STATS_RECONCILE_SECONDS', '3600'))
+
+async def record_rating_stats(teacher_id: str, rating: int):
+    """تحديث إحصائيات المعلم ذرياً بعد تقييم جديد"""
+    await db.teacher_stats.update_one(
+        {"teacher_id": teacher_id},
+        {
+            "$inc": {
+                "rating_count": 1,
+                "rating_sum": rating,
+                f"rating_distribution.{rating}": 1
+            },
+            "$set": {"updated_at": datetime.utcnow()}
+        },
+        upsert=True
+    )
+
+def rating_summary(stats: Optional[dict]) -> dict:
+    """تحويل مستند teacher_stats إلى المتوسط والعدد والتوزيع"""
+    stats = stats or {}
+    total_ratings = stats.get("rating_count", 0)
+    distribution = stats.get("rating_distribution", {})
+    return {
+        "average_rating": round(stats.get("rating_sum", 0) / total_ratings, 2) if total_ratings else 0,
+        "total_ratings": total_ratings,
+        "rating_distribution": {star: distribution.get(str(star), 0) for star in range(1, 6)}
+    }
+
+async def write_reconciled_counters(collection, key_field: str, snapshot: dict, values: dict, defaults: dict):
+    """كتابة القيم المعاد حسابها للمستندات التي لم تتغير منذ snapshot (updated_at قبل التجميع)"""
+    # المستند الذي زاده $inc أثناء التجميع يُترك ويُصحَّح في الدورة التالية بدل أن تضيع الزيادة
+    now = datetime.utcnow()
+    updates = []
+    for key in set(snapshot) | set(values):
+        fields = {**defaults, **values.get(key, {}), "updated_at": now}
+        if key in snapshot:
+            updates.append(UpdateOne({key_field: key, "updated_at": snapshot[key]}, {"$set": fields}))
+        else:
+            # لم يكن موجوداً: يُنشأ فقط إن لم تُنشئه زيادة متزامنة
+            updates.append(UpdateOne(
+                {key_field: key, "updated_at": {"$exists": False}}, {"$set": fields}, upsert=True
+            ))
+    for i in range(0, len(updates), 1000):
+        try:
+            await collection.bulk_write(updates[i:i + 1000], ordered=False)
+        except BulkWriteError as e:
+            # 11000: أُنشئ المستند بزيادة متزامنة، فيُترك للدورة التالية
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
+async def rebuild_teacher_stats(teacher_id: Optional[str] = None):
+    """إعادة بناء teacher_stats من db.ratings و db.sessions (لمعلم واحد أو للجميع)"""
+    match = {"teacher_id": teacher_id} if teacher_id else {}
+    snapshot = {
+        doc["teacher_id"]: doc.get("updated_at")
+        async for doc in db.teacher_stats.find(match, {"_id": 0, "teacher_id": 1, "updated_at": 1})
+    }
+    
+    rows = await db.ratings.aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"teacher_id": "$teacher_id", "rating": "$rating"}, "count": {"$sum": 1}}},
+        {"$group": {
+            "_id": "$_id.teacher_id",
+            "rating_count": {"$sum": "$count"},
+            "rating_sum": {"$sum": {"$multiply": ["$_id.rating", "$count"]}},
+            "buckets": {"$push": {"k": {"$toString": "$_id.rating"}, "v": "$count"}}
+        }}
+    ]).to_list(None)
+    # عدد الجلسات المكتملة
+    completed = await db.sessions.aggregate([
+        {"$match": {**match, "status": SessionStatus.COMPLETED}},
+        {"$group": {"_id": "$teacher_id", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    
+    values = {}
+    for row in rows:
+        values[row["_id"]] = {
+            "rating_count": row["rating_count"],
+            "rating_sum": row["rating_sum"],
+            "rating_distribution": {bucket["k"]: bucket["v"] for bucket in row["buckets"]}
+        }
+    for row in completed:
+        values.setdefault(row["_id"], {})["completed_sessions"] = row["count"]
+    
+    # المعلمون الذين لم يعد لهم تقييم أو جلسة مكتملة يعودون إلى الصفر
+    await write_reconciled_counters(db.teacher_stats, "teacher_id", snapshot, values, {
+        "rating_count": 0, "rating_sum": 0, "rating_distribution": {}, "completed_sessions": 0
+    })
+
+async def reconcile_teacher_stats_forever():
+    while True:
+        await asyncio.sleep(TEACHER_STATS_RECONCILE_SECONDS)
+        try:
+            await rebuild_teacher_stats()
+        except Exception as e:
+            logger.error(f"Teacher stats reconciliation failed: {str(e)}")
+
+# ===== فهرس المحادثات (conversations) =====
+# مستند واحد لكل طرفين: آخر رسالة وعدد غير المقروء لكل مستخدم
+CONVERSATION_PREVIEW_CHARS = 200
+
+def conversation_key(user_a: str, user_b: str) -> str:
+    """معرف المحادثة ثابت لأي ترتيب للطرفين"""
+    return ":".join(sorted((user_a, user_b)))
+
+def last_message_preview(message: dict) -> dict:
+    return {
+        "id": message["id"],
+        "sender_id": message["sender_id"],
+        "message": message["message"][:CONVERSATION_PREVIEW_CHARS],
+        "message_type": message.get("message_type", "text"),
+        "created_at": message["created_at"]
+    }
+
+async def record_conversation_message(message: Message):
+    """تحديث مستند المحادثة بعد إرسال رسالة"""
+    preview = last_message_preview(message.dict())
+    # $max حتى لا تعيد رسالة أقدم (وصلت متأخرة) updated_at إلى الوراء،
+    # والمحادثة الجديدة تُنشأ ومعها المعاينة
+    await db.conversations.update_one(
+        {"id": message.conversation_id},
+        {
+            "$max": {"updated_at": message.created_at},
+            "$setOnInsert": {
+                "participants": sorted((message.sender_id, message.receiver_id)),
+                "participant_types": {
+                    message.sender_id: message.sender_type,
+                    message.receiver_id: message.receiver_type
+                },
+                "last_message": preview,
+                "created_at": message.created_at
+            },
+            "$inc": {f"unread.{message.receiver_id}": 1}
+        },
+        upsert=True
+    )
+    # المعاينة لأحدث رسالة فقط
+    await db.conversations.update_one(
+        {"id": message.conversation_id, "updated_at": message.created_at},
+        {"$set": {"last_message": preview}}
+    )
+
+async def rebuild_conversations(conversation_ids: List[str]):
+    """إعادة بناء مستندات المحادثات من db.messages"""
+    for start in range(0, len(conversation_ids), 500):
+        chunk = conversation_ids[start:start + 500]
+        latest = await db.messages.aggregate([
+            {"$match": {"conversation_id": {"$in": chunk}}},
+            {"$sort": {"created_at": 1}},
+            {"$group": {"_id": "$conversation_id", "last": {"$last": "$$ROOT"}}}
+        ]).to_list(None)
+        unread = await db.messages.aggregate([
+            {"$match": {"conversation_id": {"$in": chunk}, "is_read": False}},
+            {"$group": {"_id": {"conversation_id": "$conversation_id", "receiver_id": "$receiver_id"},
+                        "count": {"$sum": 1}}}
+        ]).to_list(None)
+        unread_by_conversation = {}
+        for row in unread:
+            unread_by_conversation.setdefault(row["_id"]["conversation_id"], {})[row["_id"]["receiver_id"]] = row["count"]
+        
+        updates = []
+        for row in latest:
+            last = row["last"]
+            updates.append(UpdateOne(
+                {"id": row["_id"]},
+                {"$set": {
+                    "participants": sorted((last["sender_id"], last["receiver_id"])),
+                    "participant_types": {
+                        last["sender_id"]: last["sender_type"],
+                        last["receiver_id"]: last["receiver_type"]
+                    },
+                    "last_message": last_message_preview(last),
+                    "unread": unread_by_conversation.get(row["_id"], {}),
+                    "updated_at": last["created_at"]
+                }, "$setOnInsert": {"created_at": last["created_at"]}},
+                upsert=True
+            ))
+        if updates:
+            await db.conversations.bulk_write(updates, ordered=False)
+
+async def backfill_conversations():
+    """ربط الرسائل القديمة بمحادثاتها وبناء مستندات المحادثات لها"""
+    touched = set()
+    while True:
+        batch = await db.messages.find(
+            {"conversation_id": {"$exists": False}},
+            {"_id": 1, "sender_id": 1, "receiver_id": 1}
+        ).limit(1000).to_list(1000)
+        if not batch:
+            break
+        updates = []
+        for message in batch:
+            key = conversation_key(message["sender_id"], message["receiver_id"])
+            touched.add(key)
+            updates.append(UpdateOne({"_id": message["_id"]}, {"$set": {"conversation_id": key}}))
+        await db.messages.bulk_write(updates, ordered=False)
+    if touched:
+        await rebuild_conversations(sorted(touched))
+        logger.info(f"Backfilled {len(touched)} conversations")
+
+# ===== قناة الدفع الفوري (WebSocket) =====
+# كل مستخدم له قناة "user:<id>" في ناقل pub/sub داخل العملية، وكل اتصال له طابور
+# إرسال محدود؛ المستهلك البطيء يُفصل ليعيد المزامنة عبر REST بدلاً من تراكم الذاكرة
+WS_HEARTBEAT_SECONDS = float(os.environ.get('WS_HEARTBEAT_SECONDS', '25'))
+WS_IDLE_TIMEOUT_SECONDS = float(os.environ.get('WS_IDLE_TIMEOUT_SECONDS', '60'))
+WS_SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', '100'))
+WS_MAX_CONNECTIONS_PER_USER = int(os.environ.get('WS_MAX_CONNECTIONS_PER_USER', '5'))
+
+class InMemoryPubSub:
+    """ناقل أحداث داخل العملية؛ يمكن استبداله بوسيط خارجي بنفس الواجهة (publish/subscribe)"""
+    def __init__(self):
+        self._subscribers = {}  # channel -> {callback, ...}
+    
+    async def publish(self, channel: str, event: dict):
+        for callback in list(self._subscribers.get(channel, ())):
+            callback(event)
+    
+    def subscribe(self, channel: str, callback):
+        self._subscribers.setdefault(channel, set()).add(callback)
+        
+        def unsubscribe():
+            callbacks = self._subscribers.get(channel)
+            if callbacks is not None:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self._subscribers[channel]
+        return unsubscribe
+
+class PushConnection:
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.overflowed = asyncio.Event()
+    
+    def offer(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed.set()
+
+class ConnectionRegistry:
+    """سجل الاتصالات المفتوحة لكل مستخدم"""
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+        self._connections = {}  # user_id -> {PushConnection, ...}
+        self._unsubscribers = {}  # user_id -> unsubscribe
+    
+    def register(self, user_id: str, connection: PushConnection) -> bool:
+        connections = self._connections.setdefault(user_id, set())
+        if len(connections) >= WS_MAX_CONNECTIONS_PER_USER:
+            return False
+        connections.add(connection)
+        if user_id not in self._unsubscribers:
+            self._unsubscribers[user_id] = self.pubsub.subscribe(
+                f"user:{user_id}", lambda event: self._fan_out(user_id, event)
+            )
+        return True
+    
+    def unregister(self, user_id: str, connection: PushConnection):
+        connections = self._connections.get(user_id)
+        if connections is None:
+            return
+        connections.discard(connection)
+        if not connections:
+            del self._connections[user_id]
+            self._unsubscribers.pop(user_id)()
+    
+    def _fan_out(self, user_id: str, event: dict):
+        for connection in list(self._connections.get(user_id, ())):
+            connection.offer(event)
+
+pubsub = InMemoryPubSub()
+push_registry = ConnectionRegistry(pubsub)
+
+async def publish_user_event(user_id: str, event_type: str, payload):
+    """نشر حدث لجميع اتصالات المستخدم"""
+    await pubsub.publish(f"user:{user_id}", {"type": event_type, "data": jsonable_encoder(payload)})
+
+# ===== صندوق الإشعارات الصادرة (outbox) =====
+# المعالجات تضيف الإشعار إلى طابور داخل العملية (مع تسجيل مسبق في notification_outbox)،
+# وعامل في الخلفية يكتبها دفعات بـ insert_many ثم يرسلها عبر قناة الدفع
+NOTIFICATION_OUTBOX_DURABLE = os.environ.get('NOTIFICATION_OUTBOX_DURABLE', 'true').lower() == 'true'
+NOTIFICATION_OUTBOX_MAX_QUEUE = int(os.environ.get('NOTIFICATION_OUTBOX_MAX_QUEUE', '10000'))
+NOTIFICATION_OUTBOX_BATCH_SIZE = int(os.environ.get('NOTIFICATION_OUTBOX_BATCH_SIZE', '100'))
+NOTIFICATION_OUTBOX_LINGER_SECONDS = float(os.environ.get('NOTIFICATION_OUTBOX_LINGER_SECONDS', '0.05'))
+NOTIFICATION_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('NOTIFICATION_OUTBOX_MAX_ATTEMPTS', '5'))
+NOTIFICATION_OUTBOX_SWEEP_SECONDS = int(os.environ.get('NOTIFICATION_OUTBOX_SWEEP_SECONDS', '60'))
+# الإشعارات المقروءة تُحذف بفهرس TTL على expire_at بعد هذه المدة من قراءتها
+NOTIFICATION_READ_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_READ_RETENTION_DAYS', '30'))
+NOTIFICATION_COUNTERS_RECONCILE_SECONDS = int(os.environ.get('NOTIFICATION_COUNTERS_RECONCILE_SECONDS', '3600'))
+
+def notification_expire_at() -> datetime:
+    return datetime.utcnow() + timedelta(days=NOTIFICATION_READ_RETENTION_DAYS)
+
+async def change_unread_counts(deltas: Dict[str, int]):
+    """تعديل عداد غير المقروء (notification_counters) لعدة مستخدمين بكتابة واحدة"""
+    updates = [
+        UpdateOne(
+            {"user_id": user_id},
+            {"$inc": {"unread": delta}, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        for user_id, delta in deltas.items() if delta
+    ]
+    if updates:
+        await db.notification_counters.bulk_write(updates, ordered=False)
+
+async def rebuild_notification_counters(user_id: Optional[str] = None):
+    """إعادة بناء notification_counters من db.notifications (لمستخدم واحد أو للجميع)"""
+    match = {"user_id": user_id} if user_id else {}
+    snapshot = {
+        doc["user_id"]: doc.get("updated_at")
+        async for doc in db.notification_counters.find(match, {"_id": 0, "user_id": 1, "updated_at": 1})
+    }
+    rows = await db.notifications.aggregate([
+        {"$match": {**match, "is_read": False}},
+        {"$group": {"_id": "$user_id", "unread": {"$sum": 1}}}
+    ]).to_list(None)
+    await write_reconciled_counters(
+        db.notification_counters, "user_id", snapshot,
+        {row["_id"]: {"unread": row["unread"]} for row in rows}, {"unread": 0}
+    )
+
+async def reconcile_notification_counters_forever():
+    while True:
+        await asyncio.sleep(NOTIFICATION_COUNTERS_RECONCILE_SECONDS)
+        try:
+            await rebuild_notification_counters()
+        except Exception as e:
+            logger.error(f"Notification counters reconciliation failed: {str(e)}")
+
+class NotificationOutbox:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=NOTIFICATION_OUTBOX_MAX_QUEUE)
+        self._enqueued = 0
+        self._delivered = 0
+        self._batches = 0
+        self._retries = 0
+        self._failed = 0
+        self._overflow = 0
+        self._held = set()  # المعرفات الموجودة في الطابور أو قيد المعالجة في هذه العملية
+        self._progress = {}  # المعرف -> الخطوات المنجزة ("counted", "published")
+    
+    def _hold(self, notification: Notification) -> bool:
+        try:
+            self.queue.put_nowait(notification)
+        except asyncio.QueueFull:
+            return False
+        self._held.add(notification.id)
+        return True
+    
+    async def enqueue(self, notification: Notification):
+        """تسجيل مسبق (إن كان مفعلاً) ثم إضافة إلى الطابور دون انتظار الكتابة الفعلية"""
+        if NOTIFICATION_OUTBOX_DURABLE:
+            await db.notification_outbox.insert_one({
+                "id": notification.id,
+                "notification": notification.dict(),
+                "claimed_at": datetime.utcnow()
+            })
+        self._enqueued += 1
+        if not self._hold(notification):
+            self._overflow += 1
+            if not NOTIFICATION_OUTBOX_DURABLE:
+                # بدون تسجيل مسبق لا مكان آخر للإشعار: يُكتب مباشرة
+                try:
+                    await self._deliver([notification])
+                finally:
+                    self._progress.pop(notification.id, None)
+            # وإلا يبقى في notification_outbox حتى يلتقطه الكنس الدوري
+    
+    async def _mark(self, ids: List[str], step: str):
+        # التقدم يُحفظ لكل سجل (وليس استنتاجاً من أخطاء التكرار) حتى لا تُعاد
+        # خطوة تمت ولا تُفقد خطوة فشلت بعد كتابة الإشعار
+        for notification_id in ids:
+            self._progress.setdefault(notification_id, set()).add(step)
+        if NOTIFICATION_OUTBOX_DURABLE and ids:
+            await db.notification_outbox.update_many({"id": {"$in": ids}}, {"$set": {step: True}})
+    
+    def _pending(self, batch: List[Notification], step: str) -> List[Notification]:
+        return [n for n in batch if step not in self._progress.get(n.id, ())]
+    
+    async def _deliver(self, batch: List[Notification]):
+        try:
+            await db.notifications.insert_many([n.dict() for n in batch], ordered=False)
+        except BulkWriteError as e:
+            # إعادة المحاولة بعد كتابة جزئية: المكرر (11000) تمت كتابته سابقاً
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+        
+        uncounted = self._pending(batch, "counted")
+        deltas = {}
+        for notification in uncounted:
+            if not notification.is_read:
+                deltas[notification.user_id] = deltas.get(notification.user_id, 0) + 1
+        await change_unread_counts(deltas)
+        await self._mark([n.id for n in uncounted], "counted")
+        
+        published = []
+        try:
+            for notification in self._pending(batch, "published"):
+                # لغة المستقبل غير معروفة هنا، فيُرسل النص بكل اللغات دون تخزينه
+                texts = {
+                    language: render_notification_text(notification.dict(), language)
+                    for language in SUPPORTED_LANGUAGES
+                }
+                await publish_user_event(notification.user_id, "notification", {
+                    **notification.dict(),
+                    "title": {language: text[0] for language, text in texts.items()},
+                    "message": {language: text[1] for language, text in texts.items()}
+                })
+                published.append(notification.id)
+        finally:
+            await self._mark(published, "published")
+        if NOTIFICATION_OUTBOX_DURABLE:
+            await db.notification_outbox.delete_many({"id": {"$in": [n.id for n in batch]}})
+    
+    async def _process(self, batch: List[Notification]):
+        try:
+            for attempt in range(NOTIFICATION_OUTBOX_MAX_ATTEMPTS):
+                try:
+                    if NOTIFICATION_OUTBOX_DURABLE:
+                        # تجديد المطالبة مع كل محاولة حتى لا يلتقطها الكنس وهي قيد المعالجة
+                        await db.notification_outbox.update_many(
+                            {"id": {"$in": [n.id for n in batch]}},
+                            {"$set": {"claimed_at": datetime.utcnow()}}
+                        )
+                    await self._deliver(batch)
+                    self._batches += 1
+                    self._delivered += len(batch)
+                    return
+                except Exception as e:
+                    self._retries += 1
+                    logger.warning(f"Notification batch failed (attempt {attempt + 1}): {str(e)}")
+                    await asyncio.sleep(min(0.1 * 2 ** attempt, 5))
+            # تبقى في notification_outbox (إن كان مفعلاً) ويعيدها الكنس الدوري
+            self._failed += len(batch)
+            logger.error(f"Dropped {len(batch)} notifications after {NOTIFICATION_OUTBOX_MAX_ATTEMPTS} attempts")
+        finally:
+            for notification in batch:
+                self._held.discard(notification.id)
+                self._progress.pop(notification.id, None)
+    
+    async def _next_batch(self) -> List[Notification]:
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + NOTIFICATION_OUTBOX_LINGER_SECONDS
+        while len(batch) < NOTIFICATION_OUTBOX_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+    
+    async def run(self):
+        while True:
+            batch = await self._next_batch()
+            await self._process(batch)
+    
+    async def drain(self):
+        """كتابة ما تبقى في الطابور عند الإيقاف"""
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+            if len(batch) >= NOTIFICATION_OUTBOX_BATCH_SIZE:
+                await self._process(batch)
+                batch = []
+        if batch:
+            await self._process(batch)
+    
+    async def sweep(self, older_than_seconds: float):
+        """استعادة الإشعارات العالقة في notification_outbox (بعد إعادة تشغيل أو فشل)"""
+        if not NOTIFICATION_OUTBOX_DURABLE:
+            return
+        cutoff = datetime.utcnow() - timedelta(seconds=older_than_seconds)
+        pending = await db.notification_outbox.find(
+            {"claimed_at": {"$lte": cutoff}}, {"_id": 0, "id": 1}
+        ).limit(NOTIFICATION_OUTBOX_MAX_QUEUE).to_list(NOTIFICATION_OUTBOX_MAX_QUEUE)
+        for entry in pending:
+            if entry["id"] in self._held:
+                # ما زال في طابور هذه العملية أو قيد المعالجة
+                continue
+            # المطالبة بكل سجل حتى لا تعالجه عمليتان معاً
+            claimed = await db.notification_outbox.find_one_and_update(
+                {"id": entry["id"], "claimed_at": {"$lte": cutoff}},
+                {"$set": {"claimed_at": datetime.utcnow()}}
+            )
+            if claimed is None:
+                continue
+            steps = {step for step in ("counted", "published") if claimed.get(step)}
+            if steps:
+                self._progress[entry["id"]] = steps
+            if not self._hold(Notification(**claimed["notification"])):
+                self._progress.pop(entry["id"], None)
+                break
+    
+    async def sweep_forever(self):
+        while True:
+            await asyncio.sleep(NOTIFICATION_OUTBOX_SWEEP_SECONDS)
+            try:
+                await self.sweep(NOTIFICATION_OUTBOX_SWEEP_SECONDS)
+            except Exception as e:
+                logger.error(f"Notification outbox sweep failed: {str(e)}")
+    
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_queue": NOTIFICATION_OUTBOX_MAX_QUEUE,
+            "enqueued": self._enqueued,
+            "delivered": self._delivered,
+            "batches": self._batches,
+            "retries": self._retries,
+            "failed": self._failed,
+            "overflow": self._overflow,
+        }
+
+notification_outbox = NotificationOutbox()
+METRICS_PROVIDERS["notification_outbox"] = notification_outbox.stats
+
 async def create_notification(notification_data: NotificationCreate):
-    """إنشاء إشعار جديد"""
+    """إنشاء إشعار جديد (يُكتب ويُرسل في الخلفية عبر notification_outbox)"""
     notification = Notification(**notification_data.dict())
-    await db.notifications.insert_one(notification.dict())
+    await notification_outbox.enqueue(notification)
     return notification
 
 async def send_push_notification(user_id: str, title: str, message: str, data: dict = None):
-    """إرسال إشعار push (يحتاج تكامل مع خدمة إشعارات)"""
-    # هنا يمكن تكامل مع Firebase أو خدمة أخرى
-    pass
+    """إرسال إشعار فوري إلى اتصالات WebSocket المفتوحة للمستخدم"""
+    await publish_user_event(user_id, "push", {"title": title, "message": message, "data": data or {}})
+
+# ===== تذكير الجلسات =====
+# كومة (heap) داخل العملية لمواعيد التذكير القريبة فقط (نافذة SESSION_REMINDER_HORIZON_SECONDS)،
+# تُحمَّل عند بدء التشغيل وتُجدَّد دورياً باستعلام على فهرس (reminder_sent_at, starts_at).
+# الإرسال يُحجز بتعيين reminder_sent_at شرطياً فلا يتكرر التذكير بين العمليات أو بعد إعادة التشغيل
+SESSION_REMINDER_LEAD_MINUTES = int(os.environ.get('SESSION_REMINDER_LEAD_MINUTES', '60'))
+SESSION_REMINDER_HORIZON_SECONDS = int(os.environ.get('SESSION_REMINDER_HORIZON_SECONDS', str(6 * 3600)))
+SESSION_REMINDER_MAX_ENTRIES = int(os.environ.get('SESSION_REMINDER_MAX_ENTRIES', '100000'))
+SESSION_REMINDER_BATCH_SIZE = int(os.environ.get('SESSION_REMINDER_BATCH_SIZE', '200'))
+REMINDABLE_SESSION_STATUSES = [SessionStatus.PENDING, SessionStatus.CONFIRMED]
+
+class SessionReminderScheduler:
+    def __init__(self, lead_minutes: int, horizon_seconds: int, max_entries: int, batch_size: int):
+        self.lead = timedelta(minutes=lead_minutes)
+        self.horizon = timedelta(seconds=horizon_seconds)
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self._heap = []  # (fire_at, session_id)
+        self._entries = {}  # session_id -> fire_at (الإدخالات الأخرى في الكومة ملغاة)
+        self._wake = asyncio.Event()
+        self._horizon_end = datetime.min
+        self._refresh_at = datetime.min
+        self._claim_token = str(uuid.uuid4())
+        self._fired = 0
+        self._skipped_full = 0
+        self._rehydrations = 0
+        self._failed_batches = 0
+        self._consecutive_failures = 0
+    
+    def schedule(self, session_id: str, starts_at: Optional[datetime]):
+        """جدولة تذكير جلسة إن كان موعده داخل النافذة المحمّلة"""
+        if starts_at is None:
+            return
+        fire_at = starts_at - self.lead
+        if fire_at > self._horizon_end:
+            return  # ستُحمَّل في التجديد القادم
+        if session_id not in self._entries and len(self._entries) >= self.max_entries:
+            self._skipped_full += 1
+            return
+        self._entries[session_id] = fire_at
+        heapq.heappush(self._heap, (fire_at, session_id))
+        if self._heap[0][1] == session_id:
+            self._wake.set()
+    
+    def unschedule(self, session_id: str):
+        self._entries.pop(session_id, None)
+        # إزالة كسولة: الإدخال يبقى في الكومة ويُتجاهل، ويُعاد بناؤها إذا كثرت الملغاة
+        if len(self._heap) > 2 * len(self._entries) + 1024:
+            self._heap = [(fire_at, sid) for sid, fire_at in self._entries.items()]
+            heapq.heapify(self._heap)
+    
+    async def rehydrate(self):
+        """تحميل الجلسات التي يحين تذكيرها خلال النافذة القادمة"""
+        now = datetime.utcnow()
+        horizon_end = now + self.horizon
+        sessions = await db.sessions.find(
+            {
+                "reminder_sent_at": None,
+                "starts_at": {"$gt": now, "$lte": horizon_end + self.lead},
+                "status": {"$in": REMINDABLE_SESSION_STATUSES}
+            },
+            {"_id": 0, "id": 1, "starts_at": 1}
+        ).sort("starts_at", 1).limit(self.max_entries).to_list(self.max_entries)
+        self._horizon_end = horizon_end
+        # التجديد في منتصف النافذة حتى لا تفوت أي جلسة
+        self._refresh_at = now + self.horizon / 2
+        for session in sessions:
+            if self._entries.get(session["id"]) != session["starts_at"] - self.lead:
+                self.schedule(session["id"], session["starts_at"])
+        self._rehydrations += 1
+    
+    def _retry_later(self, session_ids: List[str], fire_at: datetime):
+        for session_id in session_ids:
+            # ما لم تُعد جدولتها أو تُلغَ أثناء المحاولة
+            if session_id not in self._entries:
+                self._entries[session_id] = fire_at
+                heapq.heappush(self._heap, (fire_at, session_id))
+    
+    def _pop_due(self, now: datetime) -> List[str]:
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            fire_at, session_id = heapq.heappop(self._heap)
+            if self._entries.get(session_id) == fire_at:
+                del self._entries[session_id]
+                due.append(session_id)
+        return due
+    
+    async def _fire(self, session_ids: List[str]):
+        # حجز الدفعة بكتابة واحدة ثم قراءة ما حجزته هذه العملية فقط
+        now = datetime.utcnow()
+        await db.sessions.update_many(
+            {
+                "id": {"$in": session_ids},
+                "reminder_sent_at": None,
+                "status": {"$in": REMINDABLE_SESSION_STATUSES},
+                "starts_at": {"$gt": now}
+            },
+            {"$set": {"reminder_sent_at": now, "reminder_claim": self._claim_token}}
+        )
+        # تشمل ما حجزته هذه العملية في محاولة سابقة فشلت قبل إرسال إشعاراته
+        sessions = await db.sessions.find(
+            {"id": {"$in": session_ids}, "reminder_claim": self._claim_token},
+            {"_id": 0, "id": 1, "student_id": 1, "teacher_id": 1, "subject": 1, "session_type": 1, "starts_at": 1}
+        ).to_list(None)
+        
+        group_ids = [s["id"] for s in sessions if s.get("session_type") == SessionType.GROUP]
+        enrolled = {}
+        if group_ids:
+            async for enrollment in db.session_enrollments.find(
+                {"session_id": {"$in": group_ids}}, {"_id": 0, "session_id": 1, "student_id": 1}
+            ):
+                enrolled.setdefault(enrollment["session_id"], set()).add(enrollment["student_id"])
+        
+        for session in sessions:
+            params = {
+                "subject": session["subject"],
+                "minutes": max(1, round((session["starts_at"] - now).total_seconds() / 60))
+            }
+            recipients = [(student_id, UserType.STUDENT)
+                          for student_id in {session["student_id"], *enrolled.get(session["id"], ())}]
+            recipients.append((session["teacher_id"], UserType.TEACHER))
+            for user_id, user_type in recipients:
+                await create_notification(NotificationCreate(
+                    user_id=user_id,
+                    user_type=user_type,
+                    notification_type=NotificationType.SESSION_REMINDER,
+                    params=params,
+                    data={"session_id": session["id"]}
+                ))
+            self._fired += 1
+    
+    async def run(self):
+        while True:
+            now = datetime.utcnow()
+            if now >= self._refresh_at:
+                try:
+                    await self.rehydrate()
+                except Exception as e:
+                    logger.error(f"Session reminder rehydration failed: {str(e)}")
+                    self._refresh_at = now + timedelta(minutes=1)
+            due = self._pop_due(now)
+            if due:
+                try:
+                    await self._fire(due)
+                    self._consecutive_failures = 0
+                except Exception as e:
+                    # تُعاد إلى الكومة بتأخير متزايد قصير؛ ما حُجز منها لن يُرسل مرتين
+                    self._failed_batches += 1
+                    self._consecutive_failures += 1
+                    backoff = min(5 * 2 ** (self._consecutive_failures - 1), 60)
+                    logger.error(f"Session reminder batch failed, retrying in {backoff}s: {str(e)}")
+                    self._retry_later(due, datetime.utcnow() + timedelta(seconds=backoff))
+                continue
+            wake_at = self._refresh_at
+            if self._heap:
+                wake_at = min(wake_at, self._heap[0][0])
+            self._wake.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), max((wake_at - now).total_seconds(), 0.01))
+    
+    def stats(self) -> dict:
+        return {
+            "scheduled": len(self._entries),
+            "heap_size": len(self._heap),
+            "horizon_end": self._horizon_end.isoformat() if self._horizon_end > datetime.min else None,
+            "fired": self._fired,
+            "skipped_full": self._skipped_full,
+            "rehydrations": self._rehydrations,
+            "failed_batches": self._failed_batches
+        }
+
+session_reminders = SessionReminderScheduler(
+    SESSION_REMINDER_LEAD_MINUTES, SESSION_REMINDER_HORIZON_SECONDS,
+    SESSION_REMINDER_MAX_ENTRIES, SESSION_REMINDER_BATCH_SIZE
+)
+METRICS_PROVIDERS["session_reminders"] = session_reminders.stats
 
 # ===== API التقييمات =====
 @api_router.post("/ratings", response_model=Rating)
@@ -155,129 +1014,229 @@ async def create_rating(
     rating = Rating(**rating_dict)
     
     await db.ratings.insert_one(rating.dict())
+    await record_rating_stats(rating.teacher_id, rating.rating)
     
     # إنشاء إشعار للمعلم
     await create_notification(NotificationCreate(
         user_id=rating_data.teacher_id,
         user_type=UserType.TEACHER,
         notification_type=NotificationType.RATING_RECEIVED,
-        title={
-            "ar": "تقييم جديد",
-            "en": "New Rating",
-            "ur": "نئی درجہ بندی"
-        },
-        message={
-            "ar": f"حصلت على تقييم {rating.rating} نجوم من {current_user['name']}",
-            "en": f"You received {rating.rating} stars rating from {current_user['name']}",
-            "ur": f"آپ کو {current_user['name']} سے {rating.rating} ستارے کی درجه بندی ملی"
-        },
+        params={"rating": rating.rating, "student_name": current_user["name"]},
         data={"rating_id": rating.id, "session_id": rating_data.session_id}
     ))
     
     return rating
 
 @api_router.get("/teachers/{teacher_id}/ratings", response_model=List[RatingResponse])
-async def get_teacher_ratings(teacher_id: str):
-    """جلب تقييمات المعلم"""
-    ratings = await db.ratings.find({"teacher_id": teacher_id}).to_list(100)
+async def get_teacher_ratings(
+    teacher_id: str,
+    response: Response,
+    limit: int = 20,
+    cursor: Optional[str] = None
+):
+    """جلب تقييمات المعلم (صفحة واحدة، والمؤشر التالي في X-Next-Cursor)"""
+    ratings = await fetch_page(
+        db.ratings, {"teacher_id": teacher_id}, "created_at", cursor, limit,
+        {"_id": 0, "id": 1, "student_id": 1, "rating": 1, "comment": 1, "created_at": 1},
+        response
+    )
     
-    result = []
-    for rating in ratings:
-        # جلب معلومات الطالب
-        student = await db.students.find_one({"id": rating["student_id"]})
-        student_name = student["name"] if student else "طالب"
-        
-        result.append(RatingResponse(
+    # جلب أسماء الطلاب دفعة واحدة بدلاً من استعلام لكل تقييم
+    student_names = await get_student_names({rating["student_id"] for rating in ratings})
+    
+    return [
+        RatingResponse(
             id=rating["id"],
-            student_name=student_name,
+            student_name=student_names.get(rating["student_id"], "طالب"),
             rating=rating["rating"],
             comment=rating.get("comment"),
             created_at=rating["created_at"]
-        ))
-    
-    return result
+        )
+        for rating in ratings
+    ]
 
 @api_router.get("/teachers/{teacher_id}/rating-stats")
 async def get_teacher_rating_stats(teacher_id: str):
     """إحصائيات تقييمات المعلم"""
-    ratings = await db.ratings.find({"teacher_id": teacher_id}).to_list(1000)
-    
-    if not ratings:
-        return {
-            "average_rating": 0,
-            "total_ratings": 0,
-            "rating_distribution": {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-        }
-    
-    total_ratings = len(ratings)
-    average_rating = sum(r["rating"] for r in ratings) / total_ratings
-    
-    distribution = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-    for rating in ratings:
-        distribution[rating["rating"]] += 1
-    
-    return {
-        "average_rating": round(average_rating, 2),
-        "total_ratings": total_ratings,
-        "rating_distribution": distribution
-    }
+    stats = await db.teacher_stats.find_one({"teacher_id": teacher_id})
+    return rating_summary(stats)
 
 # ===== API الجلسات المحسنة =====
 @api_router.post("/sessions", response_model=Session)
 async def create_session(
     session_data: SessionCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     current_user: dict = Depends(get_current_student)
 ):
-    """حجز جلسة جديدة"""
-    # التحقق من وجود المعلم
-    teacher = await db.teachers.find_one({"id": session_data.teacher_id})
-    if not teacher:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Teacher not found"
-        )
+    """حجز جلسة جديدة (إعادة المحاولة بنفس Idempotency-Key تعيد الاستجابة الأولى)"""
+    async def create():
+        # التحقق من وجود المعلم
+        teacher = await db.teachers.find_one({"id": session_data.teacher_id})
+        if not teacher:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Teacher not found"
+            )
+        
+        # إنشاء الجلسة مع حجز فترات المعلم (يفشل فوراً إذا كانت محجوزة)
+        session_dict = session_data.dict()
+        session_dict["student_id"] = current_user["id"]
+        if session_data.session_type == SessionType.INDIVIDUAL:
+            session_dict["max_students"] = 1
+        starts_at = parse_schedule_datetime(session_data.date, session_data.time)
+        session_dict["starts_at"] = starts_at
+        session_dict["ends_at"] = starts_at + timedelta(minutes=session_data.duration)
+        session = Session(**session_dict)
+        
+        try:
+            await reserve_slots(session.teacher_id, starts_at, session.duration, session.id, "session")
+        except SlotConflictError:
+            raise slot_conflict_exception()
+        try:
+            await db.sessions.insert_one(session.dict())
+        except Exception:
+            await release_slots(session.id)
+            raise
+        if session.session_type == SessionType.GROUP:
+            await db.session_enrollments.insert_one(
+                SessionEnrollment(session_id=session.id, student_id=current_user["id"]).dict()
+            )
+        session_reminders.schedule(session.id, session.starts_at)
+        
+        # إنشاء إشعار للمعلم
+        await create_notification(NotificationCreate(
+            user_id=session_data.teacher_id,
+            user_type=UserType.TEACHER,
+            notification_type=NotificationType.BOOKING_CONFIRMED,
+            params={"student_name": current_user["name"]},
+            data={"session_id": session.id}
+        ))
+        
+        return session
     
-    # إنشاء الجلسة
-    session_dict = session_data.dict()
-    session_dict["student_id"] = current_user["id"]
-    session = Session(**session_dict)
+    return await run_idempotent("sessions", current_user["id"], idempotency_key, session_data, response, create)
+
+# ===== الجلسات الجماعية =====
+# كل جلسة جماعية مستند واحد بعداد enrolled؛ الانضمام زيادة مشروطة بـ max_students
+# مع سجل في session_enrollments (فريد لكل طالب وجلسة) بدل عدّ الحجوزات
+OPEN_SESSION_STATUSES = [SessionStatus.PENDING, SessionStatus.CONFIRMED]
+
+@api_router.post("/sessions/{session_id}/enroll", response_model=Session)
+async def enroll_in_session(
+    session_id: str,
+    current_user: dict = Depends(get_current_student)
+):
+    """الانضمام إلى جلسة جماعية"""
+    # حجز المقعد بالزيادة المشروطة أولاً ثم تسجيل الانضمام؛ عند التكرار يُعاد المقعد
+    session = await db.sessions.find_one_and_update(
+        {
+            "id": session_id,
+            "session_type": SessionType.GROUP,
+            "status": {"$in": OPEN_SESSION_STATUSES},
+            "student_id": {"$ne": current_user["id"]},
+            "$expr": {"$lt": ["$enrolled", "$max_students"]}
+        },
+        {"$inc": {"enrolled": 1}, "$set": {"updated_at": datetime.utcnow()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if session is None:
+        existing = await db.sessions.find_one(
+            {"id": session_id}, {"_id": 0, "session_type": 1, "status": 1, "student_id": 1}
+        )
+        if not existing:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
+        if existing["session_type"] != SessionType.GROUP:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Not a group session")
+        if existing["student_id"] == current_user["id"]:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Already enrolled in this session")
+        if existing["status"] not in OPEN_SESSION_STATUSES:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Session is not open for enrollment")
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Session is full")
     
-    await db.sessions.insert_one(session.dict())
+    enrollment = SessionEnrollment(session_id=session_id, student_id=current_user["id"])
+    try:
+        await db.session_enrollments.insert_one(enrollment.dict())
+    except DuplicateKeyError:
+        await db.sessions.update_one(
+            {"id": session_id, "enrolled": {"$gt": 0}},
+            {"$inc": {"enrolled": -1}, "$set": {"updated_at": datetime.utcnow()}}
+        )
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Already enrolled in this session")
     
-    # إنشاء إشعار للمعلم
     await create_notification(NotificationCreate(
-        user_id=session_data.teacher_id,
+        user_id=session["teacher_id"],
         user_type=UserType.TEACHER,
         notification_type=NotificationType.BOOKING_CONFIRMED,
-        title={
-            "ar": "حجز جلسة جديدة",
-            "en": "New Session Booking",
-            "ur": "نیا سیشن بکنگ"
-        },
-        message={
-            "ar": f"طالب جديد {current_user['name']} حجز جلسة معك",
-            "en": f"New student {current_user['name']} booked a session with you",
-            "ur": f"نیا طالب {current_user['name']} نے آپ کے ساتھ سیشن بک کیا"
-        },
-        data={"session_id": session.id}
+        params={"student_name": current_user["name"]},
+        data={"session_id": session_id}
     ))
     
-    return session
+    return Session(**session)
+
+@api_router.delete("/sessions/{session_id}/enroll")
+async def leave_session(
+    session_id: str,
+    current_user: dict = Depends(get_current_student)
+):
+    """مغادرة جلسة جماعية"""
+    session = await db.sessions.find_one({"id": session_id}, {"_id": 0, "student_id": 1, "status": 1})
+    if not session:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
+    if session["student_id"] == current_user["id"]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The session owner cannot leave; cancel the session instead"
+        )
+    # الجلسات المكتملة أو الملغاة تحتفظ بقائمة المنضمين كما هي
+    if session["status"] not in OPEN_SESSION_STATUSES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Session is no longer open")
+    
+    result = await db.session_enrollments.delete_one({"session_id": session_id, "student_id": current_user["id"]})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not enrolled in this session")
+    await db.sessions.update_one(
+        {"id": session_id, "enrolled": {"$gt": 0}},
+        {"$inc": {"enrolled": -1}, "$set": {"updated_at": datetime.utcnow()}}
+    )
+    
+    return {"message": "Left session successfully"}
 
 @api_router.get("/sessions/my-sessions", response_model=List[Session])
-async def get_my_sessions(current_user: dict = Depends(get_current_user)):
-    """جلب جلسات المستخدم"""
+async def get_my_sessions(
+    response: Response,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    starts_from: Optional[datetime] = None,
+    starts_to: Optional[datetime] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """جلب جلسات المستخدم (مع نطاق زمني اختياري مرتب حسب موعد البداية)"""
     if current_user.get("user_type") == "student":
-        sessions = await db.sessions.find({"student_id": current_user["id"]}).to_list(100)
+        # الجلسات التي أنشأها الطالب والجماعية التي انضم إليها
+        enrolled = await db.session_enrollments.distinct("session_id", {"student_id": current_user["id"]})
+        query = {"$or": [{"student_id": current_user["id"]}, {"id": {"$in": enrolled}}]}
+    else:
+        query = {"teacher_id": current_user["id"]}
+    
+    window = starts_at_range(starts_from, starts_to)
+    if window:
+        sessions = await fetch_page(
+            db.sessions, {**query, **window}, "starts_at",
+            cursor, limit, SESSION_PROJECTION, response, descending=False
+        )
     else:
-        sessions = await db.sessions.find({"teacher_id": current_user["id"]}).to_list(100)
+        sessions = await fetch_page(
+            db.sessions, query, "created_at", cursor, limit, SESSION_PROJECTION, response
+        )
     
     return [Session(**session) for session in sessions]
 
 @api_router.put("/sessions/{session_id}/status")
 async def update_session_status(
     session_id: str,
-    status: SessionStatus,
+    new_status: SessionStatus = Query(..., alias="status"),
     current_user: dict = Depends(get_current_user)
 ):
     """تحديث حالة الجلسة"""
@@ -295,96 +1254,231 @@ async def update_session_status(
     elif user_type == "teacher" and session["teacher_id"] != current_user["id"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
     
-    # تحديث الحالة
-    await db.sessions.update_one(
+    # إعادة فتح جلسة ملغاة تحتاج إلى حجز فتراتها من جديد
+    cancelled = SessionStatus.CANCELLED
+    if session["status"] == cancelled and new_status != cancelled:
+        try:
+            await reserve_slots(
+                session["teacher_id"], parse_schedule_datetime(session["date"], session["time"]),
+                session.get("duration") or DEFAULT_BOOKING_DURATION_MINUTES, session_id, "session"
+            )
+        except SlotConflictError:
+            raise slot_conflict_exception()
+    
+    # تحديث الحالة مع قراءة الحالة السابقة في نفس العملية
+    previous = await db.sessions.find_one_and_update(
         {"id": session_id},
-        {"$set": {"status": status, "updated_at": datetime.utcnow()}}
+        {"$set": {"status": new_status, "updated_at": datetime.utcnow()}},
+        projection={"_id": 0, "status": 1},
+        return_document=ReturnDocument.BEFORE
     )
     
+    if new_status == cancelled and previous and previous["status"] != cancelled:
+        await release_slots(session_id)
+    if new_status in REMINDABLE_SESSION_STATUSES:
+        session_reminders.schedule(session_id, session.get("starts_at"))
+    else:
+        session_reminders.unschedule(session_id)
+    
+    # عداد الجلسات المكتملة في teacher_stats
+    was_completed = previous and previous["status"] == SessionStatus.COMPLETED
+    is_completed = new_status == SessionStatus.COMPLETED
+    if is_completed and not was_completed:
+        await db.teacher_stats.update_one(
+            {"teacher_id": session["teacher_id"]},
+            {"$inc": {"completed_sessions": 1}, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+    elif was_completed and not is_completed:
+        # لا ينزل تحت الصفر إن لم يُحسب الإكمال أصلاً (أي فرق يصححه التجميع الدوري)
+        await db.teacher_stats.update_one(
+            {"teacher_id": session["teacher_id"], "completed_sessions": {"$gt": 0}},
+            {"$inc": {"completed_sessions": -1}, "$set": {"updated_at": datetime.utcnow()}}
+        )
+    
     return {"message": "Session status updated successfully"}
 
 # ===== API الرسائل المحسنة =====
 @api_router.post("/messages", response_model=Message)
 async def send_message(
     message_data: MessageCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     current_user: dict = Depends(get_current_user)
 ):
-    """إرسال رسالة"""
-    # إنشاء الرسالة
-    message_dict = message_data.dict()
-    message_dict["sender_id"] = current_user["id"]
-    message_dict["sender_type"] = UserType(current_user.get("user_type", "student"))
+    """إرسال رسالة (إعادة المحاولة بنفس Idempotency-Key لا تكرر الرسالة)"""
+    async def create():
+        # إنشاء الرسالة
+        message_dict = message_data.dict()
+        message_dict["sender_id"] = current_user["id"]
+        message_dict["sender_type"] = UserType(current_user.get("user_type", "student"))
+        message_dict["conversation_id"] = conversation_key(current_user["id"], message_data.receiver_id)
+        
+        message = Message(**message_dict)
+        await db.messages.insert_one(message.dict())
+        await record_conversation_message(message)
+        await publish_user_event(message.receiver_id, "message", message)
+        
+        # إنشاء إشعار للمستقبل
+        await create_notification(NotificationCreate(
+            user_id=message_data.receiver_id,
+            user_type=message_data.receiver_type,
+            notification_type=NotificationType.NEW_MESSAGE,
+            params={"sender_name": current_user["name"]},
+            data={"message_id": message.id}
+        ))
+        
+        return message
+    
+    return await run_idempotent("messages", current_user["id"], idempotency_key, message_data, response, create)
+
+@api_router.get("/messages/conversations")
+async def get_conversations(
+    response: Response,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """جلب المحادثات (صندوق الوارد من فهرس المحادثات، والمؤشر التالي في X-Next-Cursor)"""
+    user_id = current_user["id"]
     
-    message = Message(**message_dict)
-    await db.messages.insert_one(message.dict())
+    conversations = await fetch_page(
+        db.conversations, {"participants": user_id}, "updated_at", cursor, limit,
+        {"_id": 0}, response
+    )
     
-    # إنشاء إشعار للمستقبل
-    await create_notification(NotificationCreate(
-        user_id=message_data.receiver_id,
-        user_type=message_data.receiver_type,
-        notification_type=NotificationType.NEW_MESSAGE,
-        title={
-            "ar": "رسالة جديدة",
-            "en": "New Message",
-            "ur": "نیا پیغام"
-        },
-        message={
-            "ar": f"رسالة جديدة من {current_user['name']}",
-            "en": f"New message from {current_user['name']}",
-            "ur": f"{current_user['name']} سے نیا پیغام"
-        },
-        data={"message_id": message.id}
-    ))
+    result = []
+    for conversation in conversations:
+        other_user_id = next(
+            (participant for participant in conversation["participants"] if participant != user_id),
+            user_id
+        )
+        result.append({
+            "id": conversation["id"],
+            "user_id": other_user_id,
+            "user_type": conversation.get("participant_types", {}).get(other_user_id),
+            "last_message": conversation.get("last_message"),
+            "unread_count": conversation.get("unread", {}).get(user_id, 0),
+            "updated_at": conversation["updated_at"]
+        })
     
-    return message
+    return result
 
-@api_router.get("/messages/conversations")
-async def get_conversations(current_user: dict = Depends(get_current_user)):
-    """جلب المحادثات"""
+@api_router.get("/messages/conversations/{other_user_id}/messages", response_model=List[Message])
+async def get_conversation_messages(
+    other_user_id: str,
+    response: Response,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """جلب رسائل محادثة واحدة (الأحدث أولاً، مقسمة إلى صفحات)"""
+    messages = await fetch_page(
+        db.messages, {"conversation_id": conversation_key(current_user["id"], other_user_id)},
+        "created_at", cursor, limit, {"_id": 0}, response
+    )
+    return [Message(**message) for message in messages]
+
+@api_router.put("/messages/conversations/{other_user_id}/read")
+async def mark_conversation_read(
+    other_user_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """تمييز رسائل المحادثة كمقروءة"""
     user_id = current_user["id"]
-    user_type = UserType(current_user.get("user_type", "student"))
+    key = conversation_key(user_id, other_user_id)
+    result = await db.messages.update_many(
+        {"conversation_id": key, "receiver_id": user_id, "is_read": False},
+        {"$set": {"is_read": True}}
+    )
+    # إنقاص العداد بعدد ما تم تمييزه فعلاً حتى لا تضيع رسالة وصلت أثناء التحديث
+    if result.modified_count:
+        await db.conversations.update_one(
+            {"id": key},
+            {"$inc": {f"unread.{user_id}": -result.modified_count}}
+        )
     
-    # جلب جميع الرسائل المرتبطة بالمستخدم
-    messages = await db.messages.find({
-        "$or": [
-            {"sender_id": user_id},
-            {"receiver_id": user_id}
-        ]
-    }).sort("created_at", -1).to_list(1000)
+    return {"message": "Conversation marked as read"}
+
+# ===== WebSocket للإشعارات والرسائل =====
+async def resolve_push_user_id(token: str) -> Optional[str]:
+    """التحقق من رمز الدخول (معلم أو طالب) وإرجاع معرف المستخدم"""
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    for resolver in (get_current_teacher, get_current_student):
+        try:
+            user = await resolver(credentials)
+            return user.id
+        except HTTPException:
+            continue
+    return None
+
+async def push_sender(connection: PushConnection):
+    """إرسال الأحداث من طابور الاتصال، مع نبضة ping عند الخمول"""
+    while True:
+        try:
+            event = await asyncio.wait_for(connection.queue.get(), WS_HEARTBEAT_SECONDS)
+        except asyncio.TimeoutError:
+            event = {"type": "ping"}
+        await connection.websocket.send_json(event)
+
+@api_router.websocket("/ws")
+async def push_channel(websocket: WebSocket, token: str):
+    """قناة دفع فوري: إشعارات ورسائل جديدة بدلاً من الاستطلاع الدوري"""
+    user_id = await resolve_push_user_id(token)
+    if user_id is None:
+        await websocket.close(code=4401)
+        return
     
-    # تجميع المحادثات
-    conversations = {}
-    for message in messages:
-        other_user_id = message["receiver_id"] if message["sender_id"] == user_id else message["sender_id"]
-        
-        if other_user_id not in conversations:
-            conversations[other_user_id] = {
-                "user_id": other_user_id,
-                "messages": [],
-                "last_message": message,
-                "unread_count": 0
-            }
-        
-        conversations[other_user_id]["messages"].append(message)
-        
-        # حساب الرسائل غير المقروءة
-        if message["receiver_id"] == user_id and not message["is_read"]:
-            conversations[other_user_id]["unread_count"] += 1
+    await websocket.accept()
+    connection = PushConnection(websocket)
+    if not push_registry.register(user_id, connection):
+        await websocket.close(code=4429)
+        return
     
-    return list(conversations.values())
+    async def receive_until_idle():
+        # أي رسالة من العميل (مثل "pong") تُعد نبضة حياة
+        while True:
+            await asyncio.wait_for(websocket.receive_text(), WS_IDLE_TIMEOUT_SECONDS)
+    
+    tasks = [
+        asyncio.create_task(push_sender(connection)),
+        asyncio.create_task(receive_until_idle()),
+        asyncio.create_task(connection.overflowed.wait())
+    ]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        push_registry.unregister(user_id, connection)
+        for task in tasks:
+            if task.done() and not task.cancelled():
+                task.exception()  # انقطاع الاتصال أو انتهاء المهلة متوقع هنا
+            task.cancel()
+        # مستهلك بطيء أو خامل: يُغلق الاتصال ويعيد العميل الاتصال والمزامنة
+        if connection.overflowed.is_set():
+            with contextlib.suppress(Exception):
+                await websocket.close(code=1013)
+        else:
+            with contextlib.suppress(Exception):
+                await websocket.close()
 
 # ===== API الإشعارات =====
-@api_router.get("/notifications", response_model=List[Notification])
+@api_router.get("/notifications", response_model=List[NotificationView])
 async def get_notifications(
     limit: int = 50,
+    language: Optional[str] = None,
+    unread_only: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
-    """جلب إشعارات المستخدم"""
-    notifications = await db.notifications.find({
-        "user_id": current_user["id"]
-    }).sort("created_at", -1).limit(limit).to_list(limit)
+    """جلب إشعارات المستخدم بلغته المفضلة"""
+    query = {"user_id": current_user["id"]}
+    if unread_only:
+        query["is_read"] = False
+    notifications = await db.notifications.find(
+        query, {"_id": 0}
+    ).sort("created_at", -1).limit(limit).to_list(limit)
     
-    return [Notification(**notif) for notif in notifications]
+    language = language if language in SUPPORTED_LANGUAGES else user_language(current_user)
+    return [render_notification(notif, language) for notif in notifications]
 
 @api_router.put("/notifications/{notification_id}/read")
 async def mark_notification_read(
@@ -393,11 +1487,15 @@ async def mark_notification_read(
 ):
     """تمييز الإشعار كمقروء"""
     result = await db.notifications.update_one(
-        {"id": notification_id, "user_id": current_user["id"]},
-        {"$set": {"is_read": True}}
+        {"id": notification_id, "user_id": current_user["id"], "is_read": False},
+        {"$set": {"is_read": True, "expire_at": notification_expire_at()}}
     )
     
-    if result.matched_count == 0:
+    if result.modified_count:
+        await change_unread_counts({current_user["id"]: -1})
+    elif not await db.notifications.count_documents(
+        {"id": notification_id, "user_id": current_user["id"]}, limit=1
+    ):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Notification not found"
@@ -408,117 +1506,283 @@ async def mark_notification_read(
 @api_router.put("/notifications/mark-all-read")
 async def mark_all_notifications_read(current_user: dict = Depends(get_current_user)):
     """تمييز جميع الإشعارات كمقروءة"""
-    await db.notifications.update_many(
+    result = await db.notifications.update_many(
         {"user_id": current_user["id"], "is_read": False},
-        {"$set": {"is_read": True}}
+        {"$set": {"is_read": True, "expire_at": notification_expire_at()}}
     )
+    # بمقدار ما تغير فعلاً: الإشعارات التي تصل أثناء التحديث تُحسب مرة واحدة
+    await change_unread_counts({current_user["id"]: -result.modified_count})
     
-    return {"message": "All notifications marked as read"}
+    return {"message": "All notifications marked as read", "updated": result.modified_count}
+
+@api_router.get("/notifications/unread-count")
+async def get_unread_notifications_count(current_user: dict = Depends(get_current_user)):
+    """عدد الإشعارات غير المقروءة (من notification_counters)"""
+    counter = await db.notification_counters.find_one(
+        {"user_id": current_user["id"]}, {"_id": 0, "unread": 1}
+    )
+    return {"unread": max((counter or {}).get("unread", 0), 0)}
 
 # ===== API إحصائيات المعلمين =====
+DASHBOARD_SERIES_FORMATS = {"week": "%G-W%V", "month": "%Y-%m"}
+DASHBOARD_SERIES_MAX_BUCKETS = 24
+
 @api_router.get("/teachers/dashboard-stats")
-async def get_teacher_dashboard_stats(current_user: dict = Depends(get_current_teacher)):
-    """إحصائيات لوحة المعلم"""
+async def get_teacher_dashboard_stats(
+    series: Optional[str] = None,
+    current_user: dict = Depends(get_current_teacher)
+):
+    """إحصائيات لوحة المعلم (استعلام $facet واحد على الجلسات + مستند teacher_stats)"""
     teacher_id = current_user["id"]
+    if series is not None and series not in DASHBOARD_SERIES_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="series must be 'week' or 'month'"
+        )
     
-    # عدد الجلسات
-    total_sessions = await db.sessions.count_documents({"teacher_id": teacher_id})
-    completed_sessions = await db.sessions.count_documents({
-        "teacher_id": teacher_id,
-        "status": SessionStatus.COMPLETED
-    })
-    pending_sessions = await db.sessions.count_documents({
-        "teacher_id": teacher_id,
-        "status": SessionStatus.PENDING
-    })
-    
-    # عدد الطلاب الفريدين
-    sessions = await db.sessions.find({"teacher_id": teacher_id}).to_list(1000)
-    unique_students = len(set(session["student_id"] for session in sessions))
-    
-    # متوسط التقييم
-    ratings = await db.ratings.find({"teacher_id": teacher_id}).to_list(1000)
-    average_rating = sum(r["rating"] for r in ratings) / len(ratings) if ratings else 0
+    completed = {"$eq": ["$status", SessionStatus.COMPLETED]}
+    facets = {
+        # عدد الجلسات والإيرادات حسب الحالة
+        "by_status": [
+            {"$group": {
+                "_id": "$status",
+                "count": {"$sum": 1},
+                "earnings": {"$sum": {"$ifNull": ["$price", 0]}}
+            }}
+        ],
+        # عدد الطلاب الفريدين
+        "students": [
+            {"$group": {"_id": "$student_id"}},
+            {"$count": "count"}
+        ]
+    }
+    if series:
+        # سلسلة زمنية للرسوم البيانية (أحدث الفترات أولاً ثم تُعكس)
+        facets["series"] = [
+            {"$group": {
+                "_id": {"$dateToString": {"format": DASHBOARD_SERIES_FORMATS[series], "date": "$created_at"}},
+                "sessions": {"$sum": 1},
+                "completed_sessions": {"$sum": {"$cond": [completed, 1, 0]}},
+                "earnings": {"$sum": {"$cond": [completed, {"$ifNull": ["$price", 0]}, 0]}}
+            }},
+            {"$sort": {"_id": -1}},
+            {"$limit": DASHBOARD_SERIES_MAX_BUCKETS}
+        ]
     
-    # الإيرادات (تحتاج حساب حسب أسعار الجلسات)
-    completed_sessions_data = await db.sessions.find({
-        "teacher_id": teacher_id,
-        "status": SessionStatus.COMPLETED
-    }).to_list(1000)
-    total_earnings = sum(session.get("price", 0) for session in completed_sessions_data)
+    facet_rows, stats = await asyncio.gather(
+        db.sessions.aggregate([
+            {"$match": {"teacher_id": teacher_id}},
+            {"$facet": facets}
+        ]).to_list(1),
+        db.teacher_stats.find_one({"teacher_id": teacher_id})
+    )
+    facet = facet_rows[0] if facet_rows else {}
+    by_status = {row["_id"]: row for row in facet.get("by_status", [])}
+    ratings = rating_summary(stats)
     
-    return {
-        "total_sessions": total_sessions,
-        "completed_sessions": completed_sessions,
-        "pending_sessions": pending_sessions,
-        "unique_students": unique_students,
-        "average_rating": round(average_rating, 2),
-        "total_earnings": total_earnings,
-        "total_ratings": len(ratings)
+    result = {
+        "total_sessions": sum(row["count"] for row in by_status.values()),
+        "completed_sessions": by_status.get(SessionStatus.COMPLETED, {}).get("count", 0),
+        "pending_sessions": by_status.get(SessionStatus.PENDING, {}).get("count", 0),
+        "unique_students": facet["students"][0]["count"] if facet.get("students") else 0,
+        "average_rating": ratings["average_rating"],
+        "total_earnings": by_status.get(SessionStatus.COMPLETED, {}).get("earnings", 0),
+        "total_ratings": ratings["total_ratings"]
     }
+    if series:
+        result["series"] = [
+            {
+                "period": row["_id"],
+                "sessions": row["sessions"],
+                "completed_sessions": row["completed_sessions"],
+                "earnings": row["earnings"]
+            }
+            for row in reversed(facet.get("series", []))
+        ]
+    
+    return result
 
 # ===== API البحث والاستكشاف =====
 @api_router.get("/teachers/search")
 async def search_teachers(
+    q: Optional[str] = None,
     subject: Optional[str] = None,
     min_rating: Optional[float] = None,
     max_price: Optional[float] = None,
     university: Optional[str] = None,
-    limit: int = 20
+    limit: int = 20,
+    skip: int = 0
 ):
-    """البحث في المعلمين"""
-    query = {"user_type": "teacher", "status": "active"}
+    """البحث في المعلمين (استعلام تجميعي واحد: تصفية وترتيب وتقسيم صفحات)"""
+    limit = max(1, min(limit, 100))
+    skip = max(0, skip)
     
+    match = {"user_type": "teacher", "status": {"$ne": "inactive"}}
+    if subject:
+        match["subjects"] = subject
+    if max_price is not None:
+        match["hourly_rate"] = {"$lte": max_price}
     if university:
-        query["university"] = {"$regex": university, "$options": "i"}
+        # مطابقة جزئية في أي موضع من الاسم ("الملك سعود" تجد "جامعة الملك سعود")؛
+        # التعبير حساس لحالة الأحرف على university_name_lc فيُفحص مفتاح الفهرس دون جلب المستندات
+        match["university_name_lc"] = {"$regex": re.escape(university_key(university))}
     
-    teachers = await db.teachers.find(query).limit(limit).to_list(limit)
+    # البحث النصي من الفهرس المقلوب في الذاكرة، مرتباً حسب الصلة
+    ranked_ids = None
+    if q:
+        ranked_ids = teacher_search_index.search(q)
+        if not ranked_ids:
+            return []
+        match["id"] = {"$in": ranked_ids}
     
-    # إضافة معلومات التقييم لكل معلم
-    result = []
-    for teacher in teachers:
-        ratings = await db.ratings.find({"teacher_id": teacher["id"]}).to_list(1000)
-        avg_rating = sum(r["rating"] for r in ratings) / len(ratings) if ratings else 0
-        
-        if min_rating and avg_rating < min_rating:
-            continue
-            
-        teacher_data = {
-            **teacher,
-            "average_rating": round(avg_rating, 2),
-            "total_ratings": len(ratings),
-            "completed_sessions": await db.sessions.count_documents({
-                "teacher_id": teacher["id"],
-                "status": SessionStatus.COMPLETED
-            })
-        }
-        result.append(teacher_data)
+    pipeline = [
+        {"$match": match},
+        {"$lookup": {
+            "from": "teacher_stats",
+            "localField": "id",
+            "foreignField": "teacher_id",
+            "as": "stats"
+        }},
+        {"$unwind": {"path": "$stats", "preserveNullAndEmptyArrays": True}},
+        {"$addFields": {
+            "total_ratings": {"$ifNull": ["$stats.rating_count", 0]},
+            "completed_sessions": {"$ifNull": ["$stats.completed_sessions", 0]},
+            "average_rating": {"$cond": [
+                {"$gt": [{"$ifNull": ["$stats.rating_count", 0]}, 0]},
+                {"$round": [{"$divide": ["$stats.rating_sum", "$stats.rating_count"]}, 2]},
+                0
+            ]}
+        }}
+    ]
+    if min_rating is not None:
+        pipeline.append({"$match": {"average_rating": {"$gte": min_rating}}})
+    if ranked_ids is not None:
+        pipeline += [
+            {"$addFields": {"relevance": {"$indexOfArray": [ranked_ids, "$id"]}}},
+            {"$sort": {"relevance": 1, "average_rating": -1, "id": 1}}
+        ]
+    else:
+        pipeline.append({"$sort": {"average_rating": -1, "total_ratings": -1, "id": 1}})
+    pipeline += [
+        {"$skip": skip},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "password_hash": 0, "stats": 0, "relevance": 0}}
+    ]
     
-    return result
+    return await db.teachers.aggregate(pipeline).to_list(limit)
+
+@api_router.get("/teachers/autocomplete")
+async def autocomplete_teachers(prefix: str, limit: int = 10):
+    """اقتراحات الإكمال التلقائي لأسماء المعلمين والمواد والجامعات"""
+    return teacher_search_index.autocomplete(prefix, max(1, min(limit, 50)))
 
 # ===== تهيئة قاعدة البيانات =====
+# الفهارس تُسجَّل في سجل الفهارس وتُنشأ عند بدء التشغيل (provision_indexes)
+register_index("students", "id", unique=True)
+register_index("teachers", "id", unique=True)
+
+# فهارس الجلسات
+register_index("sessions", "id", unique=True)
+register_index("sessions", [("student_id", 1), ("created_at", -1), ("id", -1)])
+register_index("sessions", [("teacher_id", 1), ("created_at", -1), ("id", -1)])
+register_index("sessions", [("student_id", 1), ("starts_at", 1), ("id", 1)])
+register_index("sessions", [("teacher_id", 1), ("starts_at", 1), ("id", 1)])
+register_index("sessions", "status")
+register_index("sessions", [("reminder_sent_at", 1), ("starts_at", 1)])
+register_index("session_enrollments", "id", unique=True)
+register_index("session_enrollments", [("session_id", 1), ("student_id", 1)], unique=True)
+register_index("session_enrollments", "student_id")
+
+# فهارس التقييمات
+register_index("ratings", [("teacher_id", 1), ("created_at", -1), ("id", -1)])
+register_index("ratings", [("student_id", 1), ("session_id", 1)], unique=True)
+
+register_index("teacher_stats", "teacher_id", unique=True)
+
+# فهارس البحث عن المعلمين
+register_index("teachers", [("user_type", 1), ("subjects", 1)])
+register_index("teachers", [("user_type", 1), ("hourly_rate", 1)])
+register_index("teachers", [("user_type", 1), ("university_name_lc", 1)])
+
+# فهارس الرسائل والمحادثات
+register_index("messages", [("conversation_id", 1), ("created_at", -1), ("id", -1)])
+register_index("conversations", "id", unique=True)
+register_index("conversations", [("participants", 1), ("updated_at", -1), ("id", -1)])
+
+# فهارس الإشعارات
+register_index("notifications", "id", unique=True)
+register_index("notifications", [("user_id", 1), ("created_at", -1)])
+register_index("notifications", [("user_id", 1), ("is_read", 1), ("created_at", -1)])
+register_index("notifications", "expire_at", expireAfterSeconds=0)
+register_index("notification_counters", "user_id", unique=True)
+register_index("notification_outbox", "id", unique=True)
+register_index("notification_outbox", "claimed_at")
+
+async def backfill_notification_retention():
+    """الإشعارات المقروءة قبل إضافة expire_at، وبناء العدادات عند أول تشغيل"""
+    await db.notifications.update_many(
+        {"is_read": True, "expire_at": {"$exists": False}},
+        {"$set": {"expire_at": notification_expire_at()}}
+    )
+    if not await db.notification_counters.count_documents({}, limit=1):
+        await rebuild_notification_counters()
+
+async def backfill_teacher_stats():
+    """بناء teacher_stats عند أول تشغيل بدلاً من انتظار دورة التصحيح الأولى"""
+    if not await db.teacher_stats.count_documents({}, limit=1):
+        await rebuild_teacher_stats()
+
+async def backfill_university_keys():
+    """university_name_lc للمعلمين المسجلين قبل إضافته"""
+    teachers = await db.teachers.find(
+        {"university_name_lc": {"$exists": False}}, {"_id": 0, "id": 1, "university_name": 1}
+    ).to_list(None)
+    updates = [
+        UpdateOne({"id": teacher["id"]}, {"$set": {"university_name_lc": university_key(teacher.get("university_name"))}})
+        for teacher in teachers
+    ]
+    for i in range(0, len(updates), 1000):
+        await db.teachers.bulk_write(updates[i:i + 1000], ordered=False)
+
+async def backfill_enrolled_counts():
+    """الجلسات السابقة لعداد enrolled فيها طالب واحد (منشئها)"""
+    await db.sessions.update_many({"enrolled": {"$exists": False}}, {"$set": {"enrolled": 1}})
+
+_background_tasks = []
+
 @app.on_event("startup")
-async def create_indexes():
-    """إنشاء الفهارس المطلوبة"""
-    # فهارس المستخدمين
-    await db.students.create_index("email", unique=True)
-    await db.teachers.create_index("email", unique=True)
-    
-    # فهارس الجلسات
-    await db.sessions.create_index([("student_id", 1), ("created_at", -1)])
-    await db.sessions.create_index([("teacher_id", 1), ("created_at", -1)])
-    await db.sessions.create_index("status")
-    
-    # فهارس التقييمات
-    await db.ratings.create_index([("teacher_id", 1), ("created_at", -1)])
-    await db.ratings.create_index([("student_id", 1), ("session_id", 1)], unique=True)
-    
-    # فهارس الرسائل
-    await db.messages.create_index([("sender_id", 1), ("created_at", -1)])
-    await db.messages.create_index([("receiver_id", 1), ("created_at", -1)])
-    
-    # فهارس الإشعارات
-    await db.notifications.create_index([("user_id", 1), ("created_at", -1)])
-    await db.notifications.create_index("is_read")
-    
-    print("✅ Database indexes created successfully")
\ No newline at end of file
+async def start_enhanced_background_tasks():
+    # كل خطوة تعويض مستقلة: فشل إحداها يُسجَّل ولا يمنع بقية الخطوات ولا المهام الخلفية
+    startup_steps = [
+        ("Conversation backfill", backfill_conversations),
+        ("University key backfill", backfill_university_keys),
+        ("Session schedule backfill", functools.partial(backfill_schedule_times, db.sessions, DEFAULT_BOOKING_DURATION_MINUTES)),
+        ("Session slot reservation backfill", functools.partial(backfill_slot_reservations, db.sessions, "teacher_id", "session")),
+        ("Session enrolled count backfill", backfill_enrolled_counts),
+        ("Notification retention backfill", backfill_notification_retention),
+        ("Teacher stats backfill", backfill_teacher_stats),
+        # إشعارات بقيت في notification_outbox من تشغيل سابق؛ السجلات الأحدث قد تكون
+        # لدى عملية أخرى ما زالت تعمل
+        ("Notification outbox sweep", functools.partial(notification_outbox.sweep, NOTIFICATION_OUTBOX_SWEEP_SECONDS)),
+    ]
+    for label, step in startup_steps:
+        try:
+            await step()
+        except Exception as e:
+            logger.error(f"{label} failed: {str(e)}")
+    _background_tasks.append(asyncio.create_task(notification_outbox.run()))
+    if NOTIFICATION_OUTBOX_DURABLE:
+        _background_tasks.append(asyncio.create_task(notification_outbox.sweep_forever()))
+    if TEACHER_STATS_RECONCILE_SECONDS > 0:
+        _background_tasks.append(asyncio.create_task(reconcile_teacher_stats_forever()))
+    _background_tasks.append(asyncio.create_task(session_reminders.run()))
+    if NOTIFICATION_COUNTERS_RECONCILE_SECONDS > 0:
+        _background_tasks.append(asyncio.create_task(reconcile_notification_counters_forever()))
+
+async def stop_enhanced_background_tasks():
+    for task in _background_tasks:
+        task.cancel()
+    await notification_outbox.drain()
+
+# يجب أن يعمل قبل إغلاق اتصال MongoDB حتى يُكتب ما تبقى في الطابور
+app.router.on_shutdown.insert(0, stop_enhanced_background_tasks)
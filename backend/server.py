@@ -10,12 +10,31 @@ from typing import List, Optional
 import uuid
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
-from fastapi import HTTPException, status, Depends
+from fastapi import HTTPException, status, Depends, Request, Response, Header
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse
 from jose import JWTError, jwt
 import hashlib
 import asyncio
+import base64
+import json
+import re
+import unicodedata
+import time
+import math
+import heapq
+import bisect
+import itertools
+import contextlib
+from collections import OrderedDict
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from emergentintegrations.llm.chat import LlmChat, UserMessage
+from openai import AsyncOpenAI
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import httpx
 
 
 # Configure logging
@@ -33,15 +52,96 @@ SECRET_KEY = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production'
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Verified principals are cached per token, never past the token's own exp
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.environ.get('PRINCIPAL_CACHE_TTL_SECONDS', '60'))
+PRINCIPAL_CACHE_MAX_ENTRIES = int(os.environ.get('PRINCIPAL_CACHE_MAX_ENTRIES', '10000'))
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+# bcrypt runs off the event loop in a bounded worker pool ("thread" or "process")
+PASSWORD_HASH_EXECUTOR = os.environ.get('PASSWORD_HASH_EXECUTOR', 'thread')
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '4'))
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', '64'))
+PASSWORD_HASH_RETRY_AFTER = int(os.environ.get('PASSWORD_HASH_RETRY_AFTER', '2'))
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Index registry: indexes for every collection are declared with register_index()
+# and reconciled at startup. INDEX_PROVISIONING: "apply" creates missing indexes,
+# "dry-run" only logs the missing/unused report, "off" skips both.
+INDEX_PROVISIONING = os.environ.get('INDEX_PROVISIONING', 'apply')
+
+class IndexSpec:
+    def __init__(self, collection: str, keys: list, options: dict):
+        self.collection = collection
+        self.keys = keys
+        self.options = options
+        self.name = options.get("name") or "_".join(f"{field}_{direction}" for field, direction in keys)
+
+INDEX_REGISTRY: List[IndexSpec] = []
+
+def register_index(collection: str, keys, **options):
+    if isinstance(keys, str):
+        keys = [(keys, 1)]
+    keys = list(keys)
+    for spec in INDEX_REGISTRY:
+        if spec.collection == collection and spec.keys == keys:
+            spec.options.update(options)
+            return spec
+    spec = IndexSpec(collection, keys, options)
+    INDEX_REGISTRY.append(spec)
+    return spec
+
+async def index_report():
+    report = {"missing": [], "unused": [], "undeclared": []}
+    collections = sorted({spec.collection for spec in INDEX_REGISTRY})
+    for collection in collections:
+        declared = [spec for spec in INDEX_REGISTRY if spec.collection == collection]
+        existing = await db[collection].index_information()
+        existing_keys = {
+            name: [
+                (field, int(direction) if isinstance(direction, (int, float)) else direction)
+                for field, direction in info["key"]
+            ]
+            for name, info in existing.items()
+        }
+        declared_names = set()
+        for spec in declared:
+            match = next((name for name, keys in existing_keys.items() if keys == spec.keys), None)
+            if match is None:
+                report["missing"].append(spec)
+            else:
+                declared_names.add(match)
+        for name in existing_keys:
+            if name != "_id_" and name not in declared_names:
+                report["undeclared"].append(f"{collection}.{name}")
+        try:
+            async for usage in db[collection].aggregate([{"$indexStats": {}}]):
+                if usage["name"] != "_id_" and usage["accesses"]["ops"] == 0:
+                    report["unused"].append(f"{collection}.{usage['name']}")
+        except Exception as e:
+            logger.warning(f"$indexStats unavailable for {collection}: {str(e)}")
+    return report
+
+register_index("students", "email", unique=True)
+register_index("students", "student_id", unique=True)
+register_index("students", "id", unique=True)
+register_index("teachers", "email", unique=True)
+register_index("teachers", "id", unique=True)
+register_index("bookings", "id", unique=True)
+register_index("bookings", [("student_id", 1), ("created_at", -1), ("id", -1)])
+register_index("bookings", [("student_id", 1), ("starts_at", 1), ("id", 1)])
+register_index("bookings", [("tutor_id", 1), ("starts_at", 1), ("id", 1)])
+register_index("status_checks", [("timestamp", -1), ("id", -1)])
+register_index("ai_chat_sessions", "id", unique=True)
+register_index("ai_chat_sessions", [("student_id", 1), ("updated_at", -1)])
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -55,6 +155,95 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def _timed_call(func, *args):
+    # Runs inside the worker; reports when the job actually started so the
+    # caller can split queue wait from hashing time.
+    started = time.monotonic()
+    result = func(*args)
+    return result, started, time.monotonic()
+
+class PasswordHasher:
+    def __init__(self, kind: str, workers: int, max_queue: int):
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = None
+        self._in_flight = 0
+        self._calls = 0
+        self._rejected = 0
+        self._queue_wait_total = 0.0
+        self._queue_wait_max = 0.0
+        self._hash_time_total = 0.0
+        self._hash_time_max = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="password-hash"
+                )
+        return self._executor
+
+    async def _run(self, func, *args):
+        # Jobs beyond the running workers plus max_queue are shed with a 503
+        # instead of piling up behind a login storm.
+        if self._in_flight >= self.workers + self.max_queue:
+            self._rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Authentication service is busy, please retry",
+                headers={"Retry-After": str(PASSWORD_HASH_RETRY_AFTER)},
+            )
+        self._in_flight += 1
+        submitted = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            result, started, finished = await loop.run_in_executor(
+                self._get_executor(), _timed_call, func, *args
+            )
+        finally:
+            self._in_flight -= 1
+        queue_wait = max(started - submitted, 0.0)
+        hash_time = finished - started
+        self._calls += 1
+        self._queue_wait_total += queue_wait
+        self._queue_wait_max = max(self._queue_wait_max, queue_wait)
+        self._hash_time_total += hash_time
+        self._hash_time_max = max(self._hash_time_max, hash_time)
+        return result
+
+    async def verify(self, plain_password, hashed_password):
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def hash(self, password):
+        return await self._run(get_password_hash, password)
+
+    def stats(self):
+        calls = self._calls or 1
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "in_flight": self._in_flight,
+            "calls": self._calls,
+            "rejected": self._rejected,
+            "queue_wait_avg_ms": round(self._queue_wait_total / calls * 1000, 2),
+            "queue_wait_max_ms": round(self._queue_wait_max * 1000, 2),
+            "hash_time_avg_ms": round(self._hash_time_total / calls * 1000, 2),
+            "hash_time_max_ms": round(self._hash_time_max * 1000, 2),
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+password_hasher = PasswordHasher(
+    PASSWORD_HASH_EXECUTOR, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE
+)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -62,7 +251,83 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+class PrincipalCache:
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (kind, token) -> (principal, expires_at)
+        self._keys_by_email = {}  # (kind, email) -> {(kind, token), ...}
+        # (kind, email) -> invalidation count; a lookup that read the database
+        # before an invalidate() must not cache what it read
+        self._generations = {}
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        email_key = (key[0], entry[0].email)
+        keys = self._keys_by_email.get(email_key)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_email[email_key]
+
+    def get(self, kind: str, token: str):
+        key = (kind, token)
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+            return None
+        principal, expires_at = entry
+        if time.time() >= expires_at:
+            self._remove(key)
+            self._misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return principal
+
+    def generation(self, kind: str, email: str) -> int:
+        return self._generations.get((kind, email), 0)
+
+    def put(self, kind: str, token: str, principal, token_exp: Optional[float], generation: int = 0):
+        if generation != self.generation(kind, principal.email):
+            return
+        expires_at = time.time() + self.ttl_seconds
+        if token_exp is not None:
+            expires_at = min(expires_at, float(token_exp))
+        key = (kind, token)
+        self._remove(key)
+        self._entries[key] = (principal, expires_at)
+        self._keys_by_email.setdefault((kind, principal.email), set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, kind: str, email: str):
+        self._generations[(kind, email)] = self.generation(kind, email) + 1
+        for key in list(self._keys_by_email.get((kind, email), ())):
+            self._remove(key)
+        self._invalidations += 1
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self._hits,
+            "misses": self._misses,
+            "invalidations": self._invalidations,
+        }
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_CACHE_MAX_ENTRIES)
+
 async def get_current_student(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    cached = principal_cache.get("student", credentials.credentials)
+    if cached is not None:
+        return cached
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -76,11 +341,535 @@ async def get_current_student(credentials: HTTPAuthorizationCredentials = Depend
     except JWTError:
         raise credentials_exception
     
+    generation = principal_cache.generation("student", student_email)
     student = await db.students.find_one({"email": student_email})
     if student is None:
         raise credentials_exception
     
-    return Student(**student)
+    current_student = Student(**student)
+    principal_cache.put("student", credentials.credentials, current_student, payload.get("exp"), generation)
+    return current_student
+
+
+# Keyset Pagination Helper Functions
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def clamp_page_size(limit: int) -> int:
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def encode_cursor(value: datetime, doc_id: str) -> str:
+    raw = json.dumps({"v": value.isoformat(), "id": doc_id}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_cursor(cursor: str):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(data["v"]), data["id"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+def keyset_query(query: dict, field: str, cursor: Optional[str], descending: bool = True) -> dict:
+    # Continue strictly after (field, id) in the (field, id) sort order
+    if not cursor:
+        return query
+    value, doc_id = decode_cursor(cursor)
+    op = "$lt" if descending else "$gt"
+    after = [
+        {field: {op: value}},
+        {field: value, "id": {op: doc_id}},
+    ]
+    if "$or" in query:
+        return {"$and": [query, {"$or": after}]}
+    return {**query, "$or": after}
+
+async def fetch_page(collection, query: dict, field: str, cursor: Optional[str], limit: int,
+                     projection: dict, response: Response, descending: bool = True) -> List[dict]:
+    # Reads one extra document to tell whether another page exists; the next
+    # cursor is returned in the X-Next-Cursor header so the body stays a list
+    limit = clamp_page_size(limit)
+    direction = -1 if descending else 1
+    docs = await collection.find(
+        keyset_query(query, field, cursor, descending), projection
+    ).sort([(field, direction), ("id", direction)]).limit(limit + 1).to_list(limit + 1)
+    if len(docs) > limit:
+        docs = docs[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(docs[-1][field], docs[-1]["id"])
+    return docs
+
+
+# Slot Reservations: a tutor's time is split into fixed slots and every booking or
+# session holds one slot_reservations document per slot it covers. The unique
+# (teacher_id, slot_start) index makes reserving one conditional insert, so two
+# concurrent bookings of the same slot cannot both succeed.
+SCHEDULE_TIMEZONE = ZoneInfo(os.environ.get('SCHEDULE_TIMEZONE', 'Asia/Riyadh'))
+SLOT_MINUTES = int(os.environ.get('SLOT_MINUTES', '30'))
+DEFAULT_BOOKING_DURATION_MINUTES = 60
+# Reservations for past slots are only needed until the session is over
+SLOT_RESERVATION_RETENTION_SECONDS = int(os.environ.get('SLOT_RESERVATION_RETENTION_SECONDS', str(7 * 24 * 3600)))
+
+register_index("slot_reservations", [("teacher_id", 1), ("slot_start", 1)], unique=True)
+register_index("slot_reservations", "holder_id")
+register_index("slot_reservations", "expire_at", expireAfterSeconds=0)
+
+class SlotConflictError(Exception):
+    pass
+
+def parse_schedule_datetime(date: str, time_of_day: str) -> datetime:
+    """Local YYYY-MM-DD / HH:MM in SCHEDULE_TIMEZONE -> naive UTC datetime"""
+    try:
+        local = datetime.strptime(f"{date} {time_of_day}", "%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Invalid date or time, expected YYYY-MM-DD and HH:MM"
+        )
+    return local.replace(tzinfo=SCHEDULE_TIMEZONE).astimezone(ZoneInfo("UTC")).replace(tzinfo=None)
+
+def to_naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    # Stored datetimes are naive UTC; query parameters may carry an offset
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(ZoneInfo("UTC")).replace(tzinfo=None)
+
+def starts_at_range(starts_from: Optional[datetime], starts_to: Optional[datetime]) -> dict:
+    # {"starts_at": {...}} filter for a [starts_from, starts_to) window, or {} for none
+    bounds = {}
+    if starts_from is not None:
+        bounds["$gte"] = to_naive_utc(starts_from)
+    if starts_to is not None:
+        bounds["$lt"] = to_naive_utc(starts_to)
+    return {"starts_at": bounds} if bounds else {}
+
+async def backfill_schedule_times(collection, default_duration: int):
+    # One-off migration: derive starts_at/ends_at for documents written before
+    # they existed. Documents with an unparseable date/time are left without them.
+    docs = await collection.find(
+        {"starts_at": {"$exists": False}},
+        {"_id": 0, "id": 1, "date": 1, "time": 1, "duration": 1}
+    ).to_list(None)
+    updates = []
+    skipped = 0
+    for doc in docs:
+        try:
+            starts_at = parse_schedule_datetime(doc.get("date"), doc.get("time"))
+        except HTTPException:
+            skipped += 1
+            continue
+        duration = doc.get("duration") or default_duration
+        updates.append(UpdateOne(
+            {"id": doc["id"]},
+            {"$set": {"starts_at": starts_at, "ends_at": starts_at + timedelta(minutes=duration)}}
+        ))
+    for i in range(0, len(updates), 1000):
+        await collection.bulk_write(updates[i:i + 1000], ordered=False)
+    if skipped:
+        logger.warning(f"{skipped} documents in {collection.name} have no valid date/time for starts_at")
+
+def slot_starts(starts_at: datetime, duration_minutes: int) -> List[datetime]:
+    # Every slot the interval touches, aligned to the SLOT_MINUTES grid
+    slot_seconds = SLOT_MINUTES * 60
+    epoch = datetime(1970, 1, 1)
+    first = int((starts_at - epoch).total_seconds()) // slot_seconds * slot_seconds
+    end = (starts_at - epoch).total_seconds() + duration_minutes * 60
+    return [epoch + timedelta(seconds=start) for start in range(first, math.ceil(end), slot_seconds)]
+
+def slot_conflict_exception() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="This time slot is already booked"
+    )
+
+async def reserve_slots(teacher_id: str, starts_at: datetime, duration_minutes: int,
+                        holder_id: str, holder_kind: str):
+    # Ordered insert stops at the first taken slot; the slots inserted before it
+    # are rolled back
+    now = datetime.utcnow()
+    docs = [
+        {
+            "teacher_id": teacher_id,
+            "slot_start": slot_start,
+            "holder_id": holder_id,
+            "holder_kind": holder_kind,
+            "created_at": now,
+            "expire_at": slot_start + timedelta(seconds=SLOT_RESERVATION_RETENTION_SECONDS)
+        }
+        for slot_start in slot_starts(starts_at, duration_minutes)
+    ]
+    try:
+        await db.slot_reservations.insert_many(docs, ordered=True)
+    except BulkWriteError as e:
+        inserted = [doc["slot_start"] for doc in docs[:e.details.get("nInserted", 0)]]
+        if inserted:
+            await db.slot_reservations.delete_many({"holder_id": holder_id, "slot_start": {"$in": inserted}})
+        if all(error.get("code") == 11000 for error in e.details.get("writeErrors", [])):
+            raise SlotConflictError(teacher_id)
+        raise
+
+async def release_slots(holder_id: str):
+    await db.slot_reservations.delete_many({"holder_id": holder_id})
+
+async def backfill_slot_reservations(collection, teacher_field: str, holder_kind: str):
+    # Reserves slots for upcoming bookings created before reservations existed.
+    # Conflicting legacy bookings are left as they are and logged.
+    since = (datetime.utcnow() - timedelta(days=1)).strftime("%Y-%m-%d")
+    docs = await collection.find(
+        {"date": {"$gte": since}, "status": {"$ne": "cancelled"}},
+        {"_id": 0, "id": 1, teacher_field: 1, "date": 1, "time": 1, "duration": 1}
+    ).to_list(None)
+    reserved = set(await db.slot_reservations.distinct(
+        "holder_id", {"holder_id": {"$in": [doc["id"] for doc in docs]}}
+    ))
+    conflicts = 0
+    for doc in docs:
+        if doc["id"] in reserved:
+            continue
+        try:
+            starts_at = parse_schedule_datetime(doc.get("date"), doc.get("time"))
+            await reserve_slots(
+                doc[teacher_field], starts_at,
+                doc.get("duration") or DEFAULT_BOOKING_DURATION_MINUTES, doc["id"], holder_kind
+            )
+        except (SlotConflictError, HTTPException):
+            conflicts += 1
+    if conflicts:
+        logger.warning(f"{conflicts} existing {holder_kind} entries overlap another booking or have an invalid date")
+
+
+# Idempotency Keys: a client-chosen Idempotency-Key header makes a retried POST
+# return the first response instead of running the handler again. Completed
+# responses are kept in idempotency_keys (TTL-indexed) with an in-process LRU in
+# front, so a retry is answered without touching the handler, inserts or fan-out.
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_SECONDS', str(24 * 3600)))
+IDEMPOTENCY_CACHE_MAX_ENTRIES = int(os.environ.get('IDEMPOTENCY_CACHE_MAX_ENTRIES', '10000'))
+# A pending key whose heartbeat is older than this is treated as abandoned
+# (the process died); running handlers refresh it every third of this
+IDEMPOTENCY_PENDING_TIMEOUT_SECONDS = int(os.environ.get('IDEMPOTENCY_PENDING_TIMEOUT_SECONDS', '60'))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+register_index("idempotency_keys", "key", unique=True)
+register_index("idempotency_keys", "expire_at", expireAfterSeconds=0)
+
+class IdempotencyStore:
+    def __init__(self, ttl_seconds: int, max_entries: int, pending_timeout_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.pending_timeout_seconds = pending_timeout_seconds
+        self._entries = OrderedDict()  # key -> (fingerprint, response, expires_at)
+        self._memory_hits = 0
+        self._stored_hits = 0
+        self._misses = 0
+        self._in_progress = 0
+        self._mismatches = 0
+        self._store_failures = 0
+
+    @staticmethod
+    def fingerprint(payload) -> str:
+        raw = json.dumps(jsonable_encoder(payload), sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, fingerprint: str, response):
+        self._entries[key] = (fingerprint, response, time.time() + self.ttl_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _replay(self, fingerprint: str, stored_fingerprint: str, response):
+        if fingerprint != stored_fingerprint:
+            self._mismatches += 1
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Idempotency-Key was already used with a different request body"
+            )
+        return response
+
+    async def begin(self, key: str, fingerprint: str):
+        # Returns the stored response for a completed key, or None once this
+        # caller owns the key and should run the handler
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] > time.time():
+            self._entries.move_to_end(key)
+            self._memory_hits += 1
+            return self._replay(fingerprint, entry[0], entry[1])
+
+        now = datetime.utcnow()
+        try:
+            await db.idempotency_keys.insert_one({
+                "key": key,
+                "fingerprint": fingerprint,
+                "state": "pending",
+                "created_at": now,
+                "heartbeat_at": now,
+                "expire_at": now + timedelta(seconds=self.ttl_seconds),
+            })
+            self._misses += 1
+            return None
+        except DuplicateKeyError:
+            pass
+
+        existing = await db.idempotency_keys.find_one({"key": key}, {"_id": 0})
+        if existing is None:
+            # Expired between the insert and the read
+            return await self.begin(key, fingerprint)
+        if existing["state"] == "completed":
+            self._stored_hits += 1
+            self._remember(key, existing["fingerprint"], existing["response"])
+            return self._replay(fingerprint, existing["fingerprint"], existing["response"])
+        self._replay(fingerprint, existing["fingerprint"], None)
+        if existing["state"] == "failed":
+            # The handler ran but its response was not stored; running it
+            # again would repeat the side effects
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="The request with this Idempotency-Key was processed but its response is unavailable"
+            )
+        stale_before = now - timedelta(seconds=self.pending_timeout_seconds)
+        heartbeat_at = existing.get("heartbeat_at", existing["created_at"])
+        if heartbeat_at < stale_before:
+            # Take over an abandoned key; only one retry can win the update
+            taken = await db.idempotency_keys.update_one(
+                {"key": key, "state": "pending", "heartbeat_at": existing.get("heartbeat_at")},
+                {"$set": {"heartbeat_at": now}}
+            )
+            if taken.modified_count:
+                self._misses += 1
+                return None
+        self._in_progress += 1
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A request with this Idempotency-Key is still in progress",
+            headers={"Retry-After": "1"},
+        )
+
+    async def heartbeat(self, key: str):
+        # Keeps the pending claim fresh for as long as the handler runs
+        interval = max(self.pending_timeout_seconds / 3, 1)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await db.idempotency_keys.update_one(
+                    {"key": key, "state": "pending"},
+                    {"$set": {"heartbeat_at": datetime.utcnow()}}
+                )
+            except Exception as e:
+                logger.warning(f"Idempotency heartbeat failed for {key}: {str(e)}")
+
+    async def complete(self, key: str, fingerprint: str, response):
+        # Replays from this process work even if the write below fails
+        self._remember(key, fingerprint, response)
+        try:
+            await db.idempotency_keys.update_one(
+                {"key": key},
+                {"$set": {"state": "completed", "response": response}}
+            )
+        except Exception as e:
+            self._store_failures += 1
+            logger.error(f"Could not store idempotent response for {key}: {str(e)}")
+            # Never leave it pending: a stale pending key would be taken over
+            # and the handler run again
+            with contextlib.suppress(Exception):
+                await db.idempotency_keys.update_one(
+                    {"key": key},
+                    {"$set": {"state": "failed"}}
+                )
+
+    async def abort(self, key: str):
+        # The handler failed: let the client retry with the same key
+        await db.idempotency_keys.delete_one({"key": key, "state": "pending"})
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "memory_hits": self._memory_hits,
+            "stored_hits": self._stored_hits,
+            "misses": self._misses,
+            "in_progress": self._in_progress,
+            "mismatches": self._mismatches,
+            "store_failures": self._store_failures,
+        }
+
+idempotency_store = IdempotencyStore(
+    IDEMPOTENCY_KEY_TTL_SECONDS, IDEMPOTENCY_CACHE_MAX_ENTRIES, IDEMPOTENCY_PENDING_TIMEOUT_SECONDS
+)
+
+async def run_idempotent(scope: str, principal_id: str, idempotency_key: Optional[str],
+                         payload, response: Response, handler):
+    # Runs handler() at most once per (scope, principal, key); retries get the
+    # stored JSON body back with an Idempotent-Replayed header
+    if not idempotency_key:
+        return await handler()
+    if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Idempotency-Key is too long")
+    key = f"{scope}:{principal_id}:{idempotency_key}"
+    fingerprint = IdempotencyStore.fingerprint(payload)
+    stored = await idempotency_store.begin(key, fingerprint)
+    if stored is not None:
+        response.headers["Idempotent-Replayed"] = "true"
+        return stored
+    heartbeat = asyncio.create_task(idempotency_store.heartbeat(key))
+    try:
+        result = await handler()
+    except BaseException:
+        await idempotency_store.abort(key)
+        raise
+    finally:
+        heartbeat.cancel()
+    await idempotency_store.complete(key, fingerprint, jsonable_encoder(result))
+    return result
+
+
+# Teacher Search Index: in-process inverted index over name, subjects and university
+# with Arabic/Urdu-aware normalization, prefix autocomplete and weighted ranking
+TEACHER_SEARCH_REFRESH_SECONDS = int(os.environ.get('TEACHER_SEARCH_REFRESH_SECONDS', '300'))
+
+# Harakat, superscript alef, Quranic annotation marks and tatweel
+SEARCH_DIACRITICS = re.compile("[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640]")
+SEARCH_LETTER_MAP = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي", "ی": "ي", "ئ": "ي", "ے": "ي",
+    "ک": "ك", "ة": "ه", "ۀ": "ه", "ہ": "ه", "ھ": "ه",
+    "ؤ": "و",
+})
+
+# Arabic definite article; "الرياضيات" is indexed as itself and as "رياضيات"
+SEARCH_ARTICLE = "ال"
+
+def normalize_search_text(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    text = SEARCH_DIACRITICS.sub("", text).translate(SEARCH_LETTER_MAP)
+    return "".join(ch if ch.isalnum() else " " for ch in text)
+
+def strip_search_article(token: str) -> str:
+    if token.startswith(SEARCH_ARTICLE) and len(token) - len(SEARCH_ARTICLE) >= 2:
+        return token[len(SEARCH_ARTICLE):]
+    return token
+
+def search_terms(text: str) -> List[str]:
+    return [strip_search_article(term) for term in normalize_search_text(text).split()]
+
+class TeacherSearchIndex:
+    FIELD_WEIGHTS = {"name": 3.0, "subjects": 2.0, "university_name": 1.0}
+    PREFIX_MATCH_FACTOR = 0.5
+
+    def __init__(self):
+        self._postings = {}  # token -> {teacher_id: field weight}
+        self._doc_tokens = {}  # teacher_id -> {token, ...}
+        self._sorted_tokens = []  # for prefix range scans
+        self._display = {}  # token -> first surface form seen, for suggestions
+
+    def _fields(self, teacher: dict):
+        yield "name", teacher.get("name") or ""
+        yield "university_name", teacher.get("university_name") or ""
+        for subject in teacher.get("subjects") or []:
+            yield "subjects", subject
+
+    def remove(self, teacher_id: str):
+        for token in self._doc_tokens.pop(teacher_id, ()):
+            postings = self._postings.get(token)
+            if postings is None:
+                continue
+            postings.pop(teacher_id, None)
+            if not postings:
+                del self._postings[token]
+                self._display.pop(token, None)
+                position = bisect.bisect_left(self._sorted_tokens, token)
+                if position < len(self._sorted_tokens) and self._sorted_tokens[position] == token:
+                    del self._sorted_tokens[position]
+
+    def upsert(self, teacher: dict):
+        teacher_id = teacher["id"]
+        self.remove(teacher_id)
+        if teacher.get("status") == "inactive":
+            return
+        weights = {}
+        for field, value in self._fields(teacher):
+            # Split the raw text the same way normalization does so each token
+            # keeps its own surface form ("Math/Physics" -> "Math", "Physics")
+            raw = SEARCH_DIACRITICS.sub("", unicodedata.normalize("NFKC", str(value)))
+            for word in "".join(ch if ch.isalnum() else " " for ch in raw).split():
+                for token in normalize_search_text(word).split():
+                    for form in {token, strip_search_article(token)}:
+                        weights[form] = max(weights.get(form, 0.0), self.FIELD_WEIGHTS[field])
+                        self._display.setdefault(form, word)
+        for token, weight in weights.items():
+            if token not in self._postings:
+                self._postings[token] = {}
+                bisect.insort(self._sorted_tokens, token)
+            self._postings[token][teacher_id] = weight
+        self._doc_tokens[teacher_id] = set(weights)
+
+    def _prefix_tokens(self, prefix: str):
+        position = bisect.bisect_left(self._sorted_tokens, prefix)
+        while position < len(self._sorted_tokens) and self._sorted_tokens[position].startswith(prefix):
+            yield self._sorted_tokens[position]
+            position += 1
+
+    def search(self, query: str, limit: int = 500) -> List[str]:
+        # Every query term must match a token exactly or as a prefix; exact
+        # matches score higher, rare tokens (high idf) score higher
+        terms = search_terms(query)
+        if not terms:
+            return []
+        total = max(len(self._doc_tokens), 1)
+        scores = None
+        for term in terms:
+            term_scores = {}
+            for token in self._prefix_tokens(term):
+                postings = self._postings[token]
+                idf = math.log(1 + total / len(postings))
+                factor = 1.0 if token == term else self.PREFIX_MATCH_FACTOR
+                for teacher_id, weight in postings.items():
+                    score = weight * idf * factor
+                    if score > term_scores.get(teacher_id, 0.0):
+                        term_scores[teacher_id] = score
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {
+                    teacher_id: score + term_scores[teacher_id]
+                    for teacher_id, score in scores.items() if teacher_id in term_scores
+                }
+            if not scores:
+                return []
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [teacher_id for teacher_id, _ in ranked[:limit]]
+
+    def autocomplete(self, prefix: str, limit: int = 10) -> List[dict]:
+        terms = search_terms(prefix)
+        if not terms:
+            return []
+        suggestions = [
+            {"term": self._display[token], "teachers": len(self._postings[token])}
+            for token in self._prefix_tokens(terms[-1])
+        ]
+        suggestions.sort(key=lambda item: -item["teachers"])
+        return suggestions[:limit]
+
+    async def rebuild(self):
+        teachers = await db.teachers.find(
+            {"user_type": "teacher"},
+            {"_id": 0, "id": 1, "name": 1, "university_name": 1, "subjects": 1, "status": 1}
+        ).to_list(None)
+        fresh = TeacherSearchIndex()
+        for teacher in teachers:
+            fresh.upsert(teacher)
+        self._postings, self._doc_tokens = fresh._postings, fresh._doc_tokens
+        self._sorted_tokens, self._display = fresh._sorted_tokens, fresh._display
+
+    def stats(self):
+        return {"teachers": len(self._doc_tokens), "tokens": len(self._postings)}
+
+teacher_search_index = TeacherSearchIndex()
+
+async def refresh_teacher_search_index_forever():
+    # Picks up profile changes made through other worker processes
+    while True:
+        await asyncio.sleep(TEACHER_SEARCH_REFRESH_SECONDS)
+        try:
+            await teacher_search_index.rebuild()
+        except Exception as e:
+            logger.error(f"Teacher search index refresh failed: {str(e)}")
 
 
 # Define Models
@@ -145,6 +934,9 @@ class Booking(BaseModel):
     date: str
     time: str
     status: str = "pending"  # pending, confirmed, rejected, completed
+    # UTC start/end derived from date and time, used for range queries
+    starts_at: Optional[datetime] = None
+    ends_at: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 # Original Models
@@ -156,6 +948,10 @@ class StatusCheck(BaseModel):
 class StatusCheckCreate(BaseModel):
     client_name: str
 
+# Only the fields the response models need are read back from Mongo
+BOOKING_PROJECTION = {"_id": 0, **{field: 1 for field in Booking.__fields__}}
+STATUS_CHECK_PROJECTION = {"_id": 0, **{field: 1 for field in StatusCheck.__fields__}}
+
 # Student Authentication Endpoints
 @api_router.post("/students/signup", response_model=Token)
 async def student_signup(student_signup: StudentSignup):
@@ -176,7 +972,7 @@ async def student_signup(student_signup: StudentSignup):
         )
     
     # Create new student
-    hashed_password = get_password_hash(student_signup.password)
+    hashed_password = await password_hasher.hash(student_signup.password)
     student_dict = student_signup.dict()
     del student_dict['password']
     student_dict['password_hash'] = hashed_password
@@ -202,7 +998,7 @@ async def student_signup(student_signup: StudentSignup):
 @api_router.post("/students/login", response_model=Token)
 async def student_login(student_login: StudentLogin):
     student = await db.students.find_one({"email": student_login.email})
-    if not student or not verify_password(student_login.password, student["password_hash"]):
+    if not student or not await password_hasher.verify(student_login.password, student["password_hash"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password"
@@ -237,6 +1033,7 @@ async def update_student_profile(
             {"email": current_student.email},
             {"$set": update_data}
         )
+        principal_cache.invalidate("student", current_student.email)
         
         # Fetch updated student
         updated_student = await db.students.find_one({"email": current_student.email})
@@ -250,18 +1047,19 @@ async def change_password(
     current_student: Student = Depends(get_current_student)
 ):
     # Verify current password
-    if not verify_password(password_change.current_password, current_student.password_hash):
+    if not await password_hasher.verify(password_change.current_password, current_student.password_hash):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Incorrect current password"
         )
     
     # Hash new password and update
-    new_password_hash = get_password_hash(password_change.new_password)
+    new_password_hash = await password_hasher.hash(password_change.new_password)
     await db.students.update_one(
         {"email": current_student.email},
         {"$set": {"password_hash": new_password_hash}}
     )
+    principal_cache.invalidate("student", current_student.email)
     
     return {"message": "Password changed successfully"}
 
@@ -269,18 +1067,54 @@ async def change_password(
 @api_router.post("/bookings", response_model=Booking)
 async def create_booking(
     booking_data: BookingCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     current_student: Student = Depends(get_current_student)
 ):
-    booking_dict = booking_data.dict()
-    booking_dict['student_id'] = current_student.id
-    
-    booking = Booking(**booking_dict)
-    await db.bookings.insert_one(booking.dict())
-    return booking
+    async def create():
+        booking_dict = booking_data.dict()
+        booking_dict['student_id'] = current_student.id
+        
+        starts_at = parse_schedule_datetime(booking_data.date, booking_data.time)
+        booking_dict['starts_at'] = starts_at
+        booking_dict['ends_at'] = starts_at + timedelta(minutes=DEFAULT_BOOKING_DURATION_MINUTES)
+        
+        booking = Booking(**booking_dict)
+        try:
+            await reserve_slots(booking.tutor_id, starts_at, DEFAULT_BOOKING_DURATION_MINUTES, booking.id, "booking")
+        except SlotConflictError:
+            raise slot_conflict_exception()
+        try:
+            await db.bookings.insert_one(booking.dict())
+        except Exception:
+            await release_slots(booking.id)
+            raise
+        return booking
+
+    return await run_idempotent("bookings", current_student.id, idempotency_key, booking_data, response, create)
 
 @api_router.get("/bookings", response_model=List[Booking])
-async def get_student_bookings(current_student: Student = Depends(get_current_student)):
-    bookings = await db.bookings.find({"student_id": current_student.id}).to_list(1000)
+async def get_student_bookings(
+    response: Response,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    starts_from: Optional[datetime] = None,
+    starts_to: Optional[datetime] = None,
+    current_student: Student = Depends(get_current_student)
+):
+    # With a starts_from/starts_to window, bookings come in schedule order
+    # (soonest first); otherwise newest created first
+    window = starts_at_range(starts_from, starts_to)
+    if window:
+        bookings = await fetch_page(
+            db.bookings, {"student_id": current_student.id, **window}, "starts_at",
+            cursor, limit, BOOKING_PROJECTION, response, descending=False
+        )
+    else:
+        bookings = await fetch_page(
+            db.bookings, {"student_id": current_student.id}, "created_at",
+            cursor, limit, BOOKING_PROJECTION, response
+        )
     return [Booking(**booking) for booking in bookings]
 
 @api_router.get("/bookings/{booking_id}", response_model=Booking)
@@ -304,6 +1138,7 @@ async def cancel_booking(
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Booking not found")
+    await release_slots(booking_id)
     return {"message": "Booking cancelled successfully"}
 
 # Add your routes to the router instead of directly to app
@@ -318,9 +1153,37 @@ async def create_status_check(input: StatusCheckCreate):
     _ = await db.status_checks.insert_one(status_obj.dict())
     return status_obj
 
+# Extra metrics sections registered by other modules: name -> callable returning a dict
+METRICS_PROVIDERS = {}
+
+@api_router.get("/metrics")
+async def get_metrics():
+    metrics = {
+        "password_hashing": password_hasher.stats(),
+        "principal_cache": principal_cache.stats(),
+        "llm_pool": llm_pool.stats() if llm_pool is not None else None,
+        "ai_response_cache": ai_response_cache.stats(),
+        "ai_chat_single_flight": ai_chat_single_flight.stats(),
+        "teacher_search_index": teacher_search_index.stats(),
+        "idempotency_keys": idempotency_store.stats(),
+        "ai_rate_limits": {
+            "students": ai_student_limiter.stats(),
+            "anonymous": ai_anonymous_limiter.stats(),
+        },
+    }
+    for name, provider in METRICS_PROVIDERS.items():
+        metrics[name] = provider()
+    return metrics
+
 @api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
+async def get_status_checks(
+    response: Response,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None
+):
+    status_checks = await fetch_page(
+        db.status_checks, {}, "timestamp", cursor, limit, STATUS_CHECK_PROJECTION, response
+    )
     return [StatusCheck(**status_check) for status_check in status_checks]
 
 # AI Chat Models
@@ -333,6 +1196,45 @@ class AIChatResponse(BaseModel):
     response: str
     language: str
 
+# AI Tutoring Session Models
+class AIChatSessionCreate(BaseModel):
+    language: str = "ar"
+    context: str = "educational_assistant"
+    title: Optional[str] = None
+
+class AIChatTurn(BaseModel):
+    role: str  # 'user' or 'assistant'
+    content: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class AIChatSession(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    student_id: str
+    language: str = "ar"
+    context: str = "educational_assistant"
+    title: Optional[str] = None
+    summary: str = ""  # compacted older turns
+    turns: List[AIChatTurn] = []  # recent turns kept verbatim
+    token_count: int = 0
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class AIChatSessionSummary(BaseModel):
+    id: str
+    language: str
+    context: str
+    title: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
+class AIChatSessionMessage(BaseModel):
+    message: str
+
+class AIChatSessionReply(BaseModel):
+    session_id: str
+    response: str
+    language: str
+
 # Teacher Models
 class TeacherSignup(BaseModel):
     name: str
@@ -342,6 +1244,8 @@ class TeacherSignup(BaseModel):
     years_experience: int
     gpa: float
     password: str
+    subjects: List[str] = []
+    hourly_rate: Optional[float] = Field(None, ge=0)
 
 class TeacherLogin(BaseModel):
     email: EmailStr
@@ -356,6 +1260,8 @@ class Teacher(BaseModel):
     years_experience: int
     gpa: float
     password_hash: str
+    subjects: List[str] = []
+    hourly_rate: Optional[float] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     preferences: Optional[dict] = {}
     user_type: str = "teacher"
@@ -368,10 +1274,25 @@ class TeacherResponse(BaseModel):
     university_name: str
     years_experience: int
     gpa: float
+    subjects: List[str] = []
+    hourly_rate: Optional[float] = None
     created_at: datetime
     preferences: Optional[dict] = {}
     user_type: str = "teacher"
 
+class TeacherProfileUpdate(BaseModel):
+    name: Optional[str] = None
+    phone: Optional[str] = None
+    university_name: Optional[str] = None
+    preferences: Optional[dict] = None
+    subjects: Optional[List[str]] = None
+    hourly_rate: Optional[float] = Field(None, ge=0)
+
+def university_key(university_name: Optional[str]) -> str:
+    # Stored as teachers.university_name_lc so the substring filter can run a
+    # case-sensitive regex over index keys instead of a case-insensitive one
+    return (university_name or "").casefold()
+
 # Teacher Authentication Endpoints
 @api_router.post("/teachers/signup", response_model=Token)
 async def teacher_signup(teacher_signup: TeacherSignup):
@@ -384,7 +1305,7 @@ async def teacher_signup(teacher_signup: TeacherSignup):
         )
     
     # Create new teacher
-    hashed_password = get_password_hash(teacher_signup.password)
+    hashed_password = await password_hasher.hash(teacher_signup.password)
     teacher_dict = teacher_signup.dict()
     del teacher_dict['password']
     teacher_dict['password_hash'] = hashed_password
@@ -395,7 +1316,8 @@ async def teacher_signup(teacher_signup: TeacherSignup):
     }
     
     teacher = Teacher(**teacher_dict)
-    await db.teachers.insert_one(teacher.dict())
+    await db.teachers.insert_one({**teacher.dict(), "university_name_lc": university_key(teacher.university_name)})
+    teacher_search_index.upsert(teacher.dict())
     
     # Create access token
     access_token = create_access_token(data={"sub": teacher.email, "user_type": "teacher"})
@@ -411,7 +1333,7 @@ async def teacher_signup(teacher_signup: TeacherSignup):
 @api_router.post("/teachers/login", response_model=Token)
 async def teacher_login(teacher_login: TeacherLogin):
     teacher = await db.teachers.find_one({"email": teacher_login.email})
-    if not teacher or not verify_password(teacher_login.password, teacher["password_hash"]):
+    if not teacher or not await password_hasher.verify(teacher_login.password, teacher["password_hash"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password"
@@ -429,6 +1351,10 @@ async def teacher_login(teacher_login: TeacherLogin):
     )
 
 async def get_current_teacher(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    cached = principal_cache.get("teacher", credentials.credentials)
+    if cached is not None:
+        return cached
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -443,80 +1369,784 @@ async def get_current_teacher(credentials: HTTPAuthorizationCredentials = Depend
     except JWTError:
         raise credentials_exception
     
+    generation = principal_cache.generation("teacher", teacher_email)
     teacher = await db.teachers.find_one({"email": teacher_email})
     if teacher is None:
         raise credentials_exception
     
-    return Teacher(**teacher)
+    current_teacher = Teacher(**teacher)
+    principal_cache.put("teacher", credentials.credentials, current_teacher, payload.get("exp"), generation)
+    return current_teacher
 
 @api_router.get("/teachers/profile", response_model=TeacherResponse)
 async def get_teacher_profile(current_teacher: Teacher = Depends(get_current_teacher)):
     return TeacherResponse(**current_teacher.dict())
 
-# AI Chat endpoint
-@api_router.post("/ai-chat", response_model=AIChatResponse)
-async def ai_chat(request: AIChatRequest):
-    try:
-        # Get LLM key from environment
-        llm_key = os.environ.get('EMERGENT_LLM_KEY')
-        if not llm_key:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="AI service is not configured"
-            )
-        
-        # Create system message based on language and context
-        system_messages = {
-            'ar': {
-                'educational_assistant': "أنت مساعد تعليمي ذكي يساعد الطلاب الجامعيين. قدم إجابات مفيدة ودقيقة باللغة العربية، واحرص على أن تكون تفسيراتك واضحة ومفهومة. ساعد في المواد الأكاديمية، والدراسة، وأي أسئلة تعليمية."
-            },
-            'en': {
-                'educational_assistant': "You are an intelligent educational assistant helping university students. Provide helpful and accurate answers in English, and make sure your explanations are clear and understandable. Help with academic subjects, studying, and any educational questions."
-            },
-            'ur': {
-                'educational_assistant': "آپ ایک ذہین تعلیمی اسسٹنٹ ہیں جو یونیورسٹی کے طلباء کی مدد کرتے ہیں۔ اردو میں مفید اور درست جوابات فراہم کریں، اور یقینی بنائیں کہ آپ کی وضاحات واضح اور قابل فہم ہوں۔ تعلیمی مضامین، مطالعہ، اور کسی بھی تعلیمی سوالات میں مدد کریں۔"
-            }
-        }
-        
-        # Get system message
-        system_message = system_messages.get(request.language, {}).get(
-            request.context, 
-            system_messages['en']['educational_assistant']
+@api_router.put("/teachers/profile", response_model=TeacherResponse)
+async def update_teacher_profile(
+    profile_data: TeacherProfileUpdate,
+    current_teacher: Teacher = Depends(get_current_teacher)
+):
+    # Only fields the client sent; hourly_rate is the only one that may be cleared
+    update_data = {
+        k: v for k, v in profile_data.dict(exclude_unset=True).items()
+        if v is not None or k == 'hourly_rate'
+    }
+    if 'university_name' in update_data:
+        update_data['university_name_lc'] = university_key(update_data['university_name'])
+    
+    if update_data:
+        await db.teachers.update_one(
+            {"email": current_teacher.email},
+            {"$set": update_data}
         )
+        principal_cache.invalidate("teacher", current_teacher.email)
         
-        # Initialize LLM Chat
+        # Fetch updated teacher and refresh its search entry
+        updated_teacher = await db.teachers.find_one({"email": current_teacher.email})
+        teacher_search_index.upsert(updated_teacher)
+        return TeacherResponse(**updated_teacher)
+    
+    return TeacherResponse(**current_teacher.dict())
+
+# AI Chat helpers
+AI_SYSTEM_MESSAGES = {
+    'ar': {
+        'educational_assistant': "أنت مساعد تعليمي ذكي يساعد الطلاب الجامعيين. قدم إجابات مفيدة ودقيقة باللغة العربية، واحرص على أن تكون تفسيراتك واضحة ومفهومة. ساعد في المواد الأكاديمية، والدراسة، وأي أسئلة تعليمية."
+    },
+    'en': {
+        'educational_assistant': "You are an intelligent educational assistant helping university students. Provide helpful and accurate answers in English, and make sure your explanations are clear and understandable. Help with academic subjects, studying, and any educational questions."
+    },
+    'ur': {
+        'educational_assistant': "آپ ایک ذہین تعلیمی اسسٹنٹ ہیں جو یونیورسٹی کے طلباء کی مدد کرتے ہیں۔ اردو میں مفید اور درست جوابات فراہم کریں، اور یقینی بنائیں کہ آپ کی وضاحات واضح اور قابل فہم ہوں۔ تعلیمی مضامین، مطالعہ، اور کسی بھی تعلیمی سوالات میں مدد کریں۔"
+    }
+}
+
+AI_FALLBACK_RESPONSES = {
+    'ar': "عذراً، لم أستطع معالجة طلبك في الوقت الحالي. يرجى المحاولة مرة أخرى لاحقاً.",
+    'en': "Sorry, I couldn't process your request right now. Please try again later.",
+    'ur': "معذرت، میں فی الوقت آپ کی درخواست پر عمل نہیں کر سکا۔ براہ کرم بعد میں دوبارہ کوشش کریں۔"
+}
+
+def get_ai_fallback_response(language: str) -> str:
+    return AI_FALLBACK_RESPONSES.get(language, AI_FALLBACK_RESPONSES['en'])
+
+# LLM backends: "emergent" (default), "openai" (token streaming) or "fake" (local tests)
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'emergent')
+LLM_PROVIDER = "openai"
+LLM_MODEL = os.environ.get('LLM_MODEL', 'gpt-4o-mini')
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '16'))
+LLM_KEEPALIVE_SECONDS = float(os.environ.get('LLM_KEEPALIVE_SECONDS', '60'))
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', '60'))
+
+# AI admission control: per-caller token buckets, then a bounded priority queue
+# in front of the LLM_MAX_CONCURRENCY upstream slots. Anonymous buckets are per
+# client IP, which a whole campus network may share behind NAT.
+AI_RATE_LIMIT_PER_MINUTE = float(os.environ.get('AI_RATE_LIMIT_PER_MINUTE', '60'))
+AI_RATE_LIMIT_BURST = int(os.environ.get('AI_RATE_LIMIT_BURST', '20'))
+AI_ANON_RATE_LIMIT_PER_MINUTE = float(os.environ.get('AI_ANON_RATE_LIMIT_PER_MINUTE', '30'))
+AI_ANON_RATE_LIMIT_BURST = int(os.environ.get('AI_ANON_RATE_LIMIT_BURST', '15'))
+AI_MAX_QUEUE = int(os.environ.get('AI_MAX_QUEUE', '64'))
+AI_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('AI_QUEUE_TIMEOUT_SECONDS', '10'))
+AI_RETRY_AFTER_SECONDS = int(os.environ.get('AI_RETRY_AFTER_SECONDS', '5'))
+TRUST_PROXY_HEADERS = os.environ.get('TRUST_PROXY_HEADERS', 'false').lower() == 'true'
+
+# Lower value is served first
+AI_PRIORITY_BOOKED = 0
+AI_PRIORITY_STUDENT = 1
+AI_PRIORITY_ANONYMOUS = 2
+
+class EmergentLLMBackend:
+    # LlmChat keeps the conversation on the instance, so one is built per call;
+    # the key and model are resolved once when the pool starts.
+    def __init__(self, api_key: str, model: str = LLM_MODEL):
+        self.api_key = api_key
+        self.model = model
+
+    async def complete(self, system_message: str, text: str, history: Optional[List[dict]] = None) -> str:
+        if history:
+            # Prior turns travel in the system message since each LlmChat starts empty
+            transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in history)
+            system_message = f"{system_message}\n\nConversation so far:\n{transcript}"
         chat = LlmChat(
-            api_key=llm_key,
+            api_key=self.api_key,
             session_id=f"student-chat-{uuid.uuid4()}",
             system_message=system_message
-        ).with_model("openai", "gpt-4o-mini")
-        
-        # Create user message
-        user_message = UserMessage(text=request.message)
-        
-        # Get AI response
-        ai_response = await chat.send_message(user_message)
+        ).with_model(LLM_PROVIDER, self.model)
+        return await chat.send_message(UserMessage(text=text))
+
+    async def stream(self, system_message: str, text: str, history: Optional[List[dict]] = None):
+        # LlmChat has no incremental API, so the reply arrives as one chunk
+        yield await self.complete(system_message, text, history)
+
+class OpenAILLMBackend:
+    def __init__(self, api_key: str, model: str = LLM_MODEL):
+        # One keep-alive HTTP connection pool shared by every request
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONCURRENCY,
+                max_keepalive_connections=LLM_MAX_CONCURRENCY,
+                keepalive_expiry=LLM_KEEPALIVE_SECONDS
+            ),
+            timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS)
+        )
+        self.client = AsyncOpenAI(api_key=api_key, http_client=self.http_client)
+        self.model = model
+
+    def _messages(self, system_message: str, text: str, history: Optional[List[dict]]):
+        return [
+            {"role": "system", "content": system_message},
+            *(history or []),
+            {"role": "user", "content": text},
+        ]
+
+    async def complete(self, system_message: str, text: str, history: Optional[List[dict]] = None) -> str:
+        completion = await self.client.chat.completions.create(
+            model=self.model,
+            messages=self._messages(system_message, text, history)
+        )
+        return completion.choices[0].message.content
+
+    async def stream(self, system_message: str, text: str, history: Optional[List[dict]] = None):
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=self._messages(system_message, text, history),
+            stream=True
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def close(self):
+        await self.client.close()
+
+class FakeLLMBackend:
+    def __init__(self, reply: Optional[str] = None, chunk_delay: float = 0.0,
+                 fail_after: Optional[int] = None):
+        self.reply = reply
+        self.chunk_delay = chunk_delay
+        self.fail_after = fail_after
+
+    async def complete(self, system_message: str, text: str, history: Optional[List[dict]] = None) -> str:
+        return "".join([chunk async for chunk in self.stream(system_message, text, history)])
+
+    async def stream(self, system_message: str, text: str, history: Optional[List[dict]] = None):
+        reply = self.reply or f"[fake] {text}"
+        for index, token in enumerate(re.findall(r"\S+\s*", reply)):
+            if self.fail_after is not None and index >= self.fail_after:
+                raise RuntimeError("Fake LLM backend failure")
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+            yield token
+
+def create_llm_backend():
+    if LLM_BACKEND == 'fake':
+        fail_after = os.environ.get('FAKE_LLM_FAIL_AFTER')
+        return FakeLLMBackend(
+            reply=os.environ.get('FAKE_LLM_REPLY'),
+            chunk_delay=float(os.environ.get('FAKE_LLM_CHUNK_DELAY', '0')),
+            fail_after=int(fail_after) if fail_after else None
+        )
+
+    # Get LLM key from environment
+    key_name = 'OPENAI_API_KEY' if LLM_BACKEND == 'openai' else 'EMERGENT_LLM_KEY'
+    llm_key = os.environ.get(key_name)
+    if not llm_key:
+        logger.warning(f"{key_name} is not set; AI chat will serve fallback responses")
+        return None
+    if LLM_BACKEND == 'openai':
+        return OpenAILLMBackend(llm_key)
+    return EmergentLLMBackend(llm_key)
+
+class LLMOverloadedError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("AI service is overloaded")
+        self.retry_after = retry_after
+
+class PriorityGate:
+    def __init__(self, max_concurrency: int, max_waiters: int, wait_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_waiters = max_waiters
+        self.wait_timeout = wait_timeout
+        self._active = 0
+        self._waiters = []  # heap of (priority, seq, future)
+        self._waiting = 0
+        self._seq = itertools.count()
+        self._rejected = 0
+        self._timeouts = 0
+
+    def can_admit(self) -> bool:
+        return self._active < self.max_concurrency or self._waiting < self.max_waiters
+
+    async def acquire(self, priority: int):
+        if self._active < self.max_concurrency and not self._waiting:
+            self._active += 1
+            return
+        if self._waiting >= self.max_waiters:
+            self._rejected += 1
+            raise LLMOverloadedError(AI_RETRY_AFTER_SECONDS)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(future, self.wait_timeout)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            if future.done() and not future.cancelled():
+                self.release()
+            raise LLMOverloadedError(AI_RETRY_AFTER_SECONDS)
+        except BaseException:
+            # The slot may have been handed over just as the caller gave up
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            self._waiting -= 1
+
+    def release(self):
+        # Hand the slot straight to the best waiter instead of freeing it
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            "active": self._active,
+            "waiting": self._waiting,
+            "max_waiters": self.max_waiters,
+            "rejected": self._rejected,
+            "timeouts": self._timeouts,
+        }
+
+class TokenBucketLimiter:
+    def __init__(self, rate_per_minute: float, burst: int, max_keys: int = 100000):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._throttled = 0
+
+    def hit(self, key: str) -> float:
+        # Returns 0 when allowed, otherwise seconds until a token is available
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(key, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - updated_at) * self.rate_per_second)
+        if tokens >= 1:
+            tokens -= 1
+            retry_after = 0.0
+        else:
+            retry_after = (1 - tokens) / self.rate_per_second
+            self._throttled += 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+    def stats(self):
+        return {"tracked_keys": len(self._buckets), "throttled": self._throttled}
+
+ai_student_limiter = TokenBucketLimiter(AI_RATE_LIMIT_PER_MINUTE, AI_RATE_LIMIT_BURST)
+ai_anonymous_limiter = TokenBucketLimiter(AI_ANON_RATE_LIMIT_PER_MINUTE, AI_ANON_RATE_LIMIT_BURST)
+
+BOOKED_STUDENT_CACHE_SECONDS = 300
+_booked_students = {}  # student_id -> (has_active_booking, expires_at)
+
+async def get_optional_student(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    if credentials is None:
+        return None
+    try:
+        return await get_current_student(credentials)
+    except HTTPException:
+        return None
+
+async def ai_chat_priority(student: Optional[Student]) -> int:
+    if student is None:
+        return AI_PRIORITY_ANONYMOUS
+    cached = _booked_students.get(student.id)
+    if cached is None or cached[1] <= time.monotonic():
+        booking = await db.bookings.find_one(
+            {"student_id": student.id, "status": {"$in": ["pending", "confirmed"]}},
+            {"_id": 1}
+        )
+        if len(_booked_students) >= 10000:
+            _booked_students.clear()
+        cached = (booking is not None, time.monotonic() + BOOKED_STUDENT_CACHE_SECONDS)
+        _booked_students[student.id] = cached
+    return AI_PRIORITY_BOOKED if cached[0] else AI_PRIORITY_STUDENT
+
+def client_address(http_request: Request) -> str:
+    if TRUST_PROXY_HEADERS:
+        forwarded_for = http_request.headers.get("x-forwarded-for")
+        if forwarded_for:
+            return forwarded_for.split(",")[0].strip()
+    return http_request.client.host if http_request.client else "unknown"
+
+async def admit_ai_request(http_request: Request, student: Optional[Student]) -> int:
+    if student is not None:
+        retry_after = ai_student_limiter.hit(f"student:{student.id}")
+    else:
+        retry_after = ai_anonymous_limiter.hit(f"ip:{client_address(http_request)}")
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many AI requests, please slow down",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    return await ai_chat_priority(student)
+
+def ai_overloaded_exception(retry_after: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="AI service is busy, please retry",
+        headers={"Retry-After": str(retry_after)}
+    )
+
+class LLMClientPool:
+    def __init__(self, backend, max_concurrency: int):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.gate = PriorityGate(max_concurrency, AI_MAX_QUEUE, AI_QUEUE_TIMEOUT_SECONDS)
+        # Prompts are resolved once instead of per request
+        self._system_messages = {
+            (language, context): message
+            for language, contexts in AI_SYSTEM_MESSAGES.items()
+            for context, message in contexts.items()
+        }
+        self._default_system_message = AI_SYSTEM_MESSAGES['en']['educational_assistant']
+        self._in_flight = 0
+        self._calls = 0
+
+    def system_message(self, language: str, context: str) -> str:
+        return self._system_messages.get((language, context), self._default_system_message)
+
+    async def complete(self, language: str, context: str, text: str,
+                       history: Optional[List[dict]] = None,
+                       priority: int = AI_PRIORITY_ANONYMOUS) -> str:
+        async with self.gate.slot(priority):
+            self._in_flight += 1
+            self._calls += 1
+            try:
+                return await self.backend.complete(
+                    self.system_message(language, context), text, history
+                )
+            finally:
+                self._in_flight -= 1
+
+    async def stream(self, language: str, context: str, text: str,
+                     priority: int = AI_PRIORITY_ANONYMOUS):
+        async with self.gate.slot(priority):
+            self._in_flight += 1
+            self._calls += 1
+            try:
+                async for chunk in self.backend.stream(self.system_message(language, context), text):
+                    yield chunk
+            finally:
+                self._in_flight -= 1
+
+    def stats(self):
+        return {
+            "backend": type(self.backend).__name__,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self._in_flight,
+            "calls": self._calls,
+            "queue": self.gate.stats(),
+        }
+
+    async def close(self):
+        close = getattr(self.backend, "close", None)
+        if close is not None:
+            await close()
+
+llm_pool: Optional[LLMClientPool] = None
+
+def get_llm_pool() -> LLMClientPool:
+    if llm_pool is None:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="AI service is not configured"
+        )
+    return llm_pool
+
+# AI response cache: exact tier keyed by a hash of the normalized question, plus an
+# optional near-duplicate tier (character trigram Jaccard similarity)
+AI_CACHE_MAX_ENTRIES = int(os.environ.get('AI_CACHE_MAX_ENTRIES', '2000'))
+AI_CACHE_TTL_SECONDS = int(os.environ.get('AI_CACHE_TTL_SECONDS', '86400'))
+AI_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get('AI_CACHE_SIMILARITY_THRESHOLD', '0'))
+
+def normalize_chat_text(text: str) -> str:
+    # Exact-match key: lossless for content (10/2 and 10-2 stay different)
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(text.split())
+
+def similarity_text(normalized: str) -> str:
+    # Looser form for the opt-in near-duplicate tier only: punctuation ignored
+    text = "".join(" " if unicodedata.category(ch).startswith("P") else ch for ch in normalized)
+    return " ".join(text.split())
+
+def _trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class AIResponseCache:
+    def __init__(self, max_entries: int, ttl_seconds: int, similarity_threshold: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()  # key -> (response, expires_at, scope, trigrams)
+        self._trigram_index = {}  # (scope, trigram) -> {key, ...}
+        self._exact_hits = 0
+        self._similar_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _key(self, scope, normalized: str) -> str:
+        return hashlib.sha256("\x1f".join((*scope, normalized)).encode("utf-8")).hexdigest()
+
+    def exact_key(self, message: str, language: str, context: str) -> str:
+        return self._key((language, context), normalize_chat_text(message))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, _, scope, grams = entry
+        for gram in grams:
+            keys = self._trigram_index.get((scope, gram))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._trigram_index[(scope, gram)]
+
+    def _live(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() >= entry[1]:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _most_similar(self, scope, grams: set):
+        overlaps = {}
+        for gram in grams:
+            for key in self._trigram_index.get((scope, gram), ()):
+                overlaps[key] = overlaps.get(key, 0) + 1
+        best_key, best_score = None, 0.0
+        for key, shared in overlaps.items():
+            score = shared / (len(grams) + len(self._entries[key][3]) - shared)
+            if score > best_score:
+                best_key, best_score = key, score
+        if best_score >= self.similarity_threshold:
+            return best_key
+        return None
+
+    def get(self, message: str, language: str, context: str) -> Optional[str]:
+        scope = (language, context)
+        normalized = normalize_chat_text(message)
+        response = self._live(self._key(scope, normalized))
+        if response is not None:
+            self._exact_hits += 1
+            return response
+        if self.similarity_threshold > 0:
+            key = self._most_similar(scope, _trigrams(similarity_text(normalized)))
+            response = self._live(key) if key is not None else None
+            if response is not None:
+                self._similar_hits += 1
+                return response
+        self._misses += 1
+        return None
+
+    def put(self, message: str, language: str, context: str, response: str):
+        scope = (language, context)
+        normalized = normalize_chat_text(message)
+        key = self._key(scope, normalized)
+        self._remove(key)
+        grams = _trigrams(similarity_text(normalized)) if self.similarity_threshold > 0 else set()
+        self._entries[key] = (response, time.monotonic() + self.ttl_seconds, scope, grams)
+        for gram in grams:
+            self._trigram_index.setdefault((scope, gram), set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self._evictions += 1
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "exact_hits": self._exact_hits,
+            "similar_hits": self._similar_hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+        }
+
+ai_response_cache = AIResponseCache(
+    AI_CACHE_MAX_ENTRIES, AI_CACHE_TTL_SECONDS, AI_CACHE_SIMILARITY_THRESHOLD
+)
+
+# Single-flight: concurrent identical questions share one upstream call
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}  # key -> asyncio.Task
+        self._leaders = 0
+        self._deduplicated = 0
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # mark as retrieved even if every caller went away
+
+    async def do(self, key, func):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self._leaders += 1
+        else:
+            self._deduplicated += 1
+        # Shielded so one caller disconnecting doesn't cancel the shared call
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "upstream_calls": self._leaders,
+            "deduplicated": self._deduplicated,
+        }
+
+ai_chat_single_flight = SingleFlight()
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# AI Chat endpoint
+@api_router.post("/ai-chat", response_model=AIChatResponse)
+async def ai_chat(
+    request: AIChatRequest,
+    http_request: Request,
+    current_student: Optional[Student] = Depends(get_optional_student)
+):
+    priority = await admit_ai_request(http_request, current_student)
+    try:
+        ai_response = ai_response_cache.get(request.message, request.language, request.context)
+        if ai_response is None:
+            pool = get_llm_pool()
+
+            async def fetch_response():
+                # Get AI response; the system message is selected from language and context
+                response = await pool.complete(
+                    request.language, request.context, request.message, priority=priority
+                )
+                ai_response_cache.put(request.message, request.language, request.context, response)
+                return response
+
+            flight_key = ai_response_cache.exact_key(request.message, request.language, request.context)
+            ai_response = await ai_chat_single_flight.do(flight_key, fetch_response)
         
         return AIChatResponse(
             response=ai_response,
             language=request.language
         )
         
+    except LLMOverloadedError as e:
+        raise ai_overloaded_exception(e.retry_after)
     except Exception as e:
         logger.error(f"AI Chat Error: {str(e)}")
         
         # Fallback responses based on language
-        fallback_responses = {
-            'ar': "عذراً، لم أستطع معالجة طلبك في الوقت الحالي. يرجى المحاولة مرة أخرى لاحقاً.",
-            'en': "Sorry, I couldn't process your request right now. Please try again later.",
-            'ur': "معذرت، میں فی الوقت آپ کی درخواست پر عمل نہیں کر سکا۔ براہ کرم بعد میں دوبارہ کوشش کریں۔"
-        }
-        
         return AIChatResponse(
-            response=fallback_responses.get(request.language, fallback_responses['en']),
+            response=get_ai_fallback_response(request.language),
             language=request.language
         )
 
+@api_router.post("/ai-chat/stream")
+async def ai_chat_stream(
+    request: AIChatRequest,
+    http_request: Request,
+    current_student: Optional[Student] = Depends(get_optional_student)
+):
+    # Server-Sent Events: "token" events carry deltas as the LLM produces them,
+    # "fallback" replaces the answer if the upstream fails, "done" ends the stream
+    priority = await admit_ai_request(http_request, current_student)
+    if llm_pool is not None and not llm_pool.gate.can_admit():
+        # Refuse before the 200 goes out; a later queue timeout becomes a fallback event
+        raise ai_overloaded_exception(AI_RETRY_AFTER_SECONDS)
+
+    async def event_stream():
+        cached = ai_response_cache.get(request.message, request.language, request.context)
+        if cached is not None:
+            yield _sse_event("token", {"delta": cached})
+            yield _sse_event("done", {"language": request.language})
+            return
+        try:
+            pool = get_llm_pool()
+            chunks = []
+            async for chunk in pool.stream(
+                request.language, request.context, request.message, priority=priority
+            ):
+                chunks.append(chunk)
+                yield _sse_event("token", {"delta": chunk})
+            ai_response_cache.put(request.message, request.language, request.context, "".join(chunks))
+        except Exception as e:
+            logger.error(f"AI Chat Stream Error: {str(e)}")
+            yield _sse_event("fallback", {
+                "response": get_ai_fallback_response(request.language),
+                "language": request.language
+            })
+        yield _sse_event("done", {"language": request.language})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# AI tutoring sessions: history is stored server-side and kept to a bounded window.
+# Turns that fall out of the window are folded into a capped extractive summary.
+AI_SESSION_MAX_CONTEXT_TOKENS = int(os.environ.get('AI_SESSION_MAX_CONTEXT_TOKENS', '2000'))
+AI_SESSION_MAX_SUMMARY_TOKENS = int(os.environ.get('AI_SESSION_MAX_SUMMARY_TOKENS', '400'))
+AI_SESSION_SUMMARY_LINE_CHARS = 200
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting
+    return max(1, len(text) // 4)
+
+def compact_session_history(summary: str, turns: List[dict]):
+    turns = list(turns)
+    summary_lines = summary.splitlines() if summary else []
+    turn_tokens = sum(estimate_tokens(turn["content"]) for turn in turns)
+    while turn_tokens > AI_SESSION_MAX_CONTEXT_TOKENS and len(turns) > 2:
+        dropped = turns.pop(0)
+        turn_tokens -= estimate_tokens(dropped["content"])
+        summary_lines.append(f"{dropped['role']}: {dropped['content'][:AI_SESSION_SUMMARY_LINE_CHARS]}")
+    while summary_lines and estimate_tokens("\n".join(summary_lines)) > AI_SESSION_MAX_SUMMARY_TOKENS:
+        summary_lines.pop(0)
+    summary = "\n".join(summary_lines)
+    token_count = turn_tokens + (estimate_tokens(summary) if summary else 0)
+    return summary, turns, token_count
+
+def session_history(session: dict) -> List[dict]:
+    history = []
+    if session.get("summary"):
+        history.append({
+            "role": "system",
+            "content": f"Summary of the earlier conversation:\n{session['summary']}"
+        })
+    history.extend({"role": turn["role"], "content": turn["content"]} for turn in session.get("turns", []))
+    return history
+
+@api_router.post("/ai-chat/sessions", response_model=AIChatSessionSummary)
+async def create_ai_chat_session(
+    session_data: AIChatSessionCreate,
+    current_student: Student = Depends(get_current_student)
+):
+    session = AIChatSession(student_id=current_student.id, **session_data.dict())
+    await db.ai_chat_sessions.insert_one(session.dict())
+    return AIChatSessionSummary(**session.dict())
+
+@api_router.get("/ai-chat/sessions", response_model=List[AIChatSessionSummary])
+async def get_ai_chat_sessions(
+    limit: int = 20,
+    current_student: Student = Depends(get_current_student)
+):
+    limit = max(1, min(limit, 100))
+    sessions = await db.ai_chat_sessions.find(
+        {"student_id": current_student.id},
+        {"_id": 0, "summary": 0, "turns": 0}
+    ).sort("updated_at", -1).limit(limit).to_list(limit)
+    return [AIChatSessionSummary(**session) for session in sessions]
+
+@api_router.get("/ai-chat/sessions/{session_id}", response_model=AIChatSession)
+async def get_ai_chat_session(
+    session_id: str,
+    current_student: Student = Depends(get_current_student)
+):
+    session = await db.ai_chat_sessions.find_one({"id": session_id, "student_id": current_student.id})
+    if not session:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    return AIChatSession(**session)
+
+@api_router.delete("/ai-chat/sessions/{session_id}")
+async def delete_ai_chat_session(
+    session_id: str,
+    current_student: Student = Depends(get_current_student)
+):
+    result = await db.ai_chat_sessions.delete_one({"id": session_id, "student_id": current_student.id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    return {"message": "Chat session deleted successfully"}
+
+@api_router.post("/ai-chat/sessions/{session_id}/messages", response_model=AIChatSessionReply)
+async def send_ai_chat_session_message(
+    session_id: str,
+    chat_message: AIChatSessionMessage,
+    http_request: Request,
+    current_student: Student = Depends(get_current_student)
+):
+    priority = await admit_ai_request(http_request, current_student)
+    session = await db.ai_chat_sessions.find_one({"id": session_id, "student_id": current_student.id})
+    if not session:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+
+    try:
+        ai_response = await get_llm_pool().complete(
+            session["language"], session["context"], chat_message.message,
+            history=session_history(session), priority=priority
+        )
+    except LLMOverloadedError as e:
+        raise ai_overloaded_exception(e.retry_after)
+    except Exception as e:
+        logger.error(f"AI Chat Session Error: {str(e)}")
+        return AIChatSessionReply(
+            session_id=session_id,
+            response=get_ai_fallback_response(session["language"]),
+            language=session["language"]
+        )
+
+    turns = session.get("turns", []) + [
+        AIChatTurn(role="user", content=chat_message.message).dict(),
+        AIChatTurn(role="assistant", content=ai_response).dict(),
+    ]
+    summary, turns, token_count = compact_session_history(session.get("summary", ""), turns)
+
+    # Conditional on updated_at so two concurrent replies cannot drop each other's turns
+    result = await db.ai_chat_sessions.update_one(
+        {"id": session_id, "updated_at": session["updated_at"]},
+        {"$set": {
+            "summary": summary,
+            "turns": turns,
+            "token_count": token_count,
+            "updated_at": datetime.utcnow()
+        }}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Chat session was updated concurrently, please retry"
+        )
+
+    return AIChatSessionReply(
+        session_id=session_id,
+        response=ai_response,
+        language=session["language"]
+    )
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -526,8 +2156,70 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Idempotent-Replayed"],
 )
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+
+@app.on_event("shutdown")
+async def shutdown_password_hasher():
+    password_hasher.shutdown()
+
+@app.on_event("startup")
+async def start_llm_pool():
+    global llm_pool
+    backend = create_llm_backend()
+    if backend is not None:
+        llm_pool = LLMClientPool(backend, LLM_MAX_CONCURRENCY)
+
+@app.on_event("shutdown")
+async def shutdown_llm_pool():
+    if llm_pool is not None:
+        await llm_pool.close()
+
+@app.on_event("startup")
+async def provision_indexes():
+    if INDEX_PROVISIONING == 'off':
+        return
+    report = await index_report()
+    for spec in report["missing"]:
+        if INDEX_PROVISIONING == 'apply':
+            try:
+                await db[spec.collection].create_index(spec.keys, **{"name": spec.name, **spec.options})
+                logger.info(f"Created index {spec.collection}.{spec.name}")
+            except Exception as e:
+                logger.error(f"Could not create index {spec.collection}.{spec.name}: {str(e)}")
+        else:
+            logger.info(f"Missing index {spec.collection}.{spec.name} (dry run)")
+    if report["undeclared"]:
+        logger.info(f"Indexes not in the registry: {', '.join(report['undeclared'])}")
+    if report["unused"]:
+        logger.info(f"Indexes with no recorded use since server start: {', '.join(report['unused'])}")
+
+@app.on_event("startup")
+async def reserve_existing_booking_slots():
+    try:
+        await backfill_schedule_times(db.bookings, DEFAULT_BOOKING_DURATION_MINUTES)
+        await backfill_slot_reservations(db.bookings, "tutor_id", "booking")
+    except Exception as e:
+        logger.error(f"Booking schedule backfill failed: {str(e)}")
+
+_teacher_search_refresh_task = None
+
+@app.on_event("startup")
+async def build_teacher_search_index():
+    global _teacher_search_refresh_task
+    # An empty index only hides search results until the next periodic refresh
+    try:
+        await teacher_search_index.rebuild()
+    except Exception as e:
+        logger.error(f"Teacher search index build failed: {str(e)}")
+    if TEACHER_SEARCH_REFRESH_SECONDS > 0:
+        _teacher_search_refresh_task = asyncio.create_task(refresh_teacher_search_index_forever())
+
+@app.on_event("shutdown")
+async def stop_teacher_search_refresh():
+    if _teacher_search_refresh_task is not None:
+        _teacher_search_refresh_task.cancel()